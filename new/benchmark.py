@@ -0,0 +1,416 @@
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+LOGGER = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Old pages are slow to parse, so only a sample of each corpus is converted
+DEFAULT_PARSE_SAMPLE = 500
+
+# Share of variant and comparison links pointing at stops that don't exist
+MISSING_RATIO = 0.1
+
+ORGANS = 20
+CLIPS_PER_ORGAN = 10
+CLIP_BYTES = 4096
+# Header of a 128 kbit/s, 44.1 kHz MPEG-1 layer III frame, 417 bytes long
+FRAME_HEADER = b"\xff\xfb\x90\x00"
+FRAME_BYTES = 417
+# A transparent 1x1 GIF
+GIF = b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!" \
+    b"\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00" \
+    b"\x00\x02\x02D\x01\x00;"
+
+PREFIXES = (
+    "", "Contra ", "Echo ", "Grand ", "Lieblich ", "Rohr", "Doppel", "Sub ",
+    "Super ", "Klein ", "Nacht", "Spitz", "Gross ", "Still ", "Wald",
+    "Zart ", "Hohl", "Harmonic ", "Open ", "Stopped ",
+)
+BASES = (
+    "Bourdon", "Flute", "Gedeckt", "Principal", "Trumpet", "Gamba", "Oboe",
+    "Quint", "Diapason", "Cornet", "Viola", "Dulciana", "Mixture", "Regal",
+    "Celeste", "Clarion", "Bassoon", "Nasard", "Tierce", "Salicional",
+    "Krummhorn", "Schalmei", "Piccolo", "Tuba", "Horn",
+)
+ORIGINS = ("English", "French", "German", "Italian", "Spanish", "Dutch",
+           "Unknown")
+CLIP_NAMES = ("Arpeggio", "St. Anne")
+
+OLD_PAGE = """<html>
+<head>
+<title>Encyclopedia of Organ Stops</title>
+</head>
+<body>
+
+<!--NAMES-->
+<table width=100%><tr><td>
+{names}
+</td></tr></table>
+
+<p>
+{description}
+<p>
+{images}
+<p/>
+
+<h2>Variants</h2>
+<table><tr valign=top><td>
+{variants}
+</td></tr></table>
+
+<h2>Examples</h2>
+Examples of <i>{name}</i> are common.
+</p>
+
+{examples}
+
+<h2>Sound Clips</h2>
+<table class=samples cellpadding=0 cellspacing=0>
+<tr><td colspan=2><b>Manual {name}</b></td></tr>
+{clips}
+</table>
+
+<!--FOOTER-->
+</body>
+</html>
+"""
+
+
+def get_stop_name(index):
+    name = PREFIXES[index % len(PREFIXES)] + \
+        BASES[(index // len(PREFIXES)) % len(BASES)]
+    repeat = index // (len(PREFIXES) * len(BASES))
+    if repeat:
+        name += f" {repeat + 1}"
+    return name
+
+
+def get_name_url(name):
+    return name.replace(" ", "_")
+
+
+def get_link(rng, stop_names):
+    if rng.random() < MISSING_RATIO:
+        return f"Missing {rng.randrange(len(stop_names))}"
+    return rng.choice(stop_names)
+
+
+def generate_definition(rng, name, stop_names, organs):
+    names = [{
+        "name": name,
+        "origin": rng.choice(ORIGINS),
+        "link": "",
+        "primary": True,
+    }]
+    for synonym in range(rng.randint(2, 8)):
+        names.append({
+            "name": f"{name} {rng.choice(ORIGINS)} {synonym}",
+            "origin": rng.choice(ORIGINS),
+            "link": get_link(rng, stop_names) if rng.random() < 0.2 else "",
+            "primary": False,
+        })
+
+    variants = []
+    for _ in range(rng.randint(0, 10)):
+        link = get_link(rng, stop_names)
+        # Most variants are listed under the name of the page they link to
+        variant = link if rng.random() < 0.7 else f"{link} Variant"
+        variants.append({"name": variant, "link": link})
+
+    comparisons = [{"name": link, "link": link} for link in
+                   (get_link(rng, stop_names)
+                    for _ in range(rng.randint(0, 3)))]
+
+    clips = []
+    for clip in range(rng.randint(0, 4)):
+        organ = rng.choice(organs)
+        clips.append({
+            "files": [{
+                "name": clip_name,
+                "file": f"clip{rng.randrange(CLIPS_PER_ORGAN)}.mp3",
+            } for clip_name in CLIP_NAMES],
+            "name": f"{name} 8', Great",
+            "organLink": organ,
+            "organName": f"{organ} Church",
+            "organBuilderName": "Synthetic & Sons, 1900",
+        })
+
+    return {
+        "images": [{"file": f"{get_name_url(name)}{image}$.gif",
+                    "subtitle": ""} for image in range(rng.randint(0, 3))],
+        "names": names,
+        "description": " ".join(
+            [f"The {name} is a synthetic stop."] * rng.randint(1, 20)),
+        "construction": "",
+        "usage": "",
+        "variants": variants,
+        "comparisons": comparisons,
+        "examplesDescription": f"Examples of {name}",
+        "examples": [{
+            "link": "",
+            "name": f"{name} 8', Manual; Church {example}, Somewhere; "
+                    f"Builder {example}.",
+        } for example in range(rng.randint(0, 15))],
+        "soundClips": [{"divisionName": "Manual", "clips": clips}]
+        if clips else [],
+        "bibliography": [],
+    }
+
+
+def generate_clip(rng):
+    frames = CLIP_BYTES // FRAME_BYTES
+    return b"".join(FRAME_HEADER + rng.randbytes(FRAME_BYTES - 4)
+                    for _ in range(frames))
+
+
+def generate_corpus(root, size, seed):
+    """Write a definitions, audio and images tree with `size` stops."""
+    rng = random.Random(seed)
+    stop_names = [get_stop_name(index) for index in range(size)]
+    organs = [f"Organ{organ}" for organ in range(ORGANS)]
+
+    for organ in organs:
+        os.makedirs(os.path.join(root, "audio", organ))
+        for clip in range(CLIPS_PER_ORGAN):
+            with open(os.path.join(root, "audio", organ, f"clip{clip}.mp3"),
+                      "wb") as output:
+                output.write(generate_clip(rng))
+
+    os.makedirs(os.path.join(root, "images", "a"))
+    with open(os.path.join(root, "images", "a", "Image.gif"), "wb") as output:
+        output.write(GIF)
+
+    # The compiler reads its templates relative to the working directory
+    os.symlink(os.path.join(HERE, "templates"),
+               os.path.join(root, "templates"))
+
+    definitions = {}
+    for name in stop_names:
+        definition = generate_definition(rng, name, stop_names, organs)
+        path = os.path.join(root, "definitions", name[0].lower(),
+                            get_name_url(name) + ".json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as output:
+            json.dump(definition, output)
+        definitions[name] = definition
+
+    return definitions
+
+
+def generate_old_page(name, definition):
+    names = "\n".join(
+        f"<font size=+3><b>{item['name']} </b></font> {item['origin']}<br>"
+        + ("\t<!--PRIMARY-->" if item['primary'] else "")
+        for item in definition['names'])
+    images = "\n".join(f'<img src="{image["file"]}">'
+                       for image in definition['images'])
+    variants = "\n".join(
+        f'<a href="../{item["link"][0].lower()}/'
+        f'{get_name_url(item["link"])}.html">{item["name"]}</a><br>'
+        for item in definition['variants'])
+    examples = "\n".join(f"<p class=example>{item['name']}</p>"
+                         for item in definition['examples'])
+    clips = "\n".join(
+        f"""<tr class=samples>
+    <td class=samples>{clip['name']}</td>
+    <td class=samples><a href="../_sounds/{clip['organLink']}/index.html">
+            {clip['organName']}</a></td>
+    <td class=samples>{clip['organBuilderName']}</td>
+""" + "\n".join(
+            f'    <td class=samples><a href="../_sounds/{clip["organLink"]}/'
+            f'{file["file"]}">{file["name"]}</a></td>'
+            for file in clip['files']) + "\n    </tr>"
+        for division in definition['soundClips']
+        for clip in division['clips'])
+
+    return OLD_PAGE.format(name=name, names=names,
+                           description=definition['description'],
+                           images=images, variants=variants,
+                           examples=examples, clips=clips)
+
+
+def generate_old_corpus(root, definitions, count):
+    paths = []
+    for name in list(definitions)[:count]:
+        path = os.path.join(root, "old", name[0].lower(),
+                            get_name_url(name).replace("_", "") + ".html")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as output:
+            output.write(generate_old_page(name, definitions[name]))
+        paths.append(path)
+
+    return paths
+
+
+@contextmanager
+def timed(results, phase):
+    start = time.perf_counter()
+    yield
+    results[phase] = round(time.perf_counter() - start, 4)
+    LOGGER.info(f"{phase}: {results[phase]}s")
+
+
+def benchmark_compile(jobs, trace_memory):
+    import compile
+
+    def build(incremental):
+        config = compile.BuildConfig(incremental=incremental, jobs=jobs)
+        stats = compile.main(config, compile.BuildStats(trace_memory))
+        LOGGER.info(f"build took {stats.phases['build']['seconds']:.4f}s")
+        return stats.report(top=5)
+
+    results = {'full_build': build(False)}
+    del results['full_build']['pages']
+    results['incremental_noop'] = build(True)['phases']
+
+    path = compile.listDefinitions()[0]
+    with open(path) as data:
+        definition = json.load(data)
+    definition['description'] += " Edited."
+    with open(path, "w") as output:
+        json.dump(definition, output)
+    results['incremental_one_change'] = build(True)['phases']
+
+    with open(os.path.join(compile.BUILD_DIR, compile.MANIFEST_FILE)) as data:
+        manifest = json.load(data)
+    results['missing_pages'] = len(manifest['missing'])
+    return results
+
+
+def benchmark_parse(paths):
+    from bs4 import BeautifulSoup
+
+    import converter
+
+    results = {'files': len(paths)}
+    texts = []
+    for path in paths:
+        with open(path) as data:
+            texts.append(data.read())
+
+    with timed(results, "tree_build"):
+        for text in texts:
+            BeautifulSoup(text, converter.DEFAULT_PARSER).decompose()
+    with timed(results, "parse_old_file"):
+        for path in paths:
+            converter.parse_old_file(path)
+
+    # The steps of parse_old_file, in its order, each summed over all files
+    table_steps = ["extract_stop_names", "extract_summary_text"]
+    document_steps = ["extract_images", "extract_variants",
+                      "extract_comparisons", "extract_example_data",
+                      "extract_sound_clips", "extract_bibliography"]
+    steps = dict.fromkeys(["index_document"] + table_steps + document_steps,
+                          0)
+
+    def step(name, *args):
+        start = time.perf_counter()
+        value = getattr(converter, name)(*args)
+        steps[name] += time.perf_counter() - start
+        return value
+
+    for text in texts:
+        soup = BeautifulSoup(text, converter.DEFAULT_PARSER)
+        document = step("index_document", soup)
+        for table in document.name_tables:
+            for name in table_steps:
+                step(name, table)
+        for name in document_steps:
+            step(name, document)
+        soup.decompose()
+
+    for name, duration in steps.items():
+        results[name] = round(duration, 4)
+        LOGGER.info(f"{name}: {results[name]}s")
+
+    results['per_file'] = round(results['parse_old_file'] / len(paths), 6) \
+        if paths else 0
+    return results
+
+
+def main(sizes, seed, parse_sample, jobs, trace_memory=False,
+         work_dir=None):
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.utcnow().isoformat(),
+        'seed': seed,
+        'jobs': jobs,
+        'traceMemory': trace_memory,
+        'sizes': {},
+    }
+    cwd = os.getcwd()
+
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix=f"organstops-{size}-", dir=work_dir)
+        LOGGER.info(f"benchmarking {size} stops in {root}")
+        try:
+            results = {}
+            with timed(results, "generate"):
+                definitions = generate_corpus(root, size, seed)
+                paths = generate_old_corpus(root, definitions,
+                                            min(size, parse_sample))
+
+            os.chdir(root)
+            results['compile'] = benchmark_compile(jobs, trace_memory)
+            results['convert'] = benchmark_parse(paths)
+            report['sizes'][str(size)] = results
+
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=int, nargs="+",
+                        default=DEFAULT_SIZES,
+                        help="Number of stops in each synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for generating the corpora")
+    parser.add_argument("-p", "--parse-sample", type=int,
+                        default=DEFAULT_PARSE_SAMPLE,
+                        help="Number of old pages to parse for each corpus")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes rendering stop pages")
+    parser.add_argument("-m", "--trace-memory", action='store_true',
+                        help="If given, also measure the peak memory of "
+                        "each build phase")
+    parser.add_argument("-w", "--work-directory", type=str,
+                        help="Where to generate the corpora")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Path to write the JSON results to, "
+                        "defaults to stdout")
+    args = parser.parse_args()
+
+    # The build logs every file at DEBUG, which would swamp the timings
+    logging.getLogger("compile").setLevel(logging.WARNING)
+    logging.getLogger("converter").setLevel(logging.WARNING)
+
+    report = main(args.sizes, args.seed, args.parse_sample, args.jobs,
+                  args.trace_memory, args.work_directory)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
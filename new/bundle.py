@@ -0,0 +1,131 @@
+"""A single SQLite file holding every definition, for reading them quickly.
+
+The JSON files under definitions/ stay the source of truth. Syncing a bundle
+only reads the files whose size or modification time changed since they
+were last stored in it.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS definitions (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS definitions_name ON definitions (name);
+"""
+
+
+def getPrimaryName(text):
+    """Return the name a definition's page is built under, like compile.py
+    does, or None if it has no names or can't be parsed."""
+    # Malformed definitions are left for model.loadStop() to report
+    try:
+        names = json.loads(text).get('names')
+        if not names:
+            return None
+        for item in names:
+            if item.get('primary'):
+                return item['name'].strip()
+        name = names[0]['name']
+        return name if isinstance(name, str) else None
+    except (json.decoder.JSONDecodeError, AttributeError, KeyError,
+            TypeError):
+        return None
+
+
+class Bundle:
+    """Definitions stored by their path relative to root."""
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            LOGGER.debug(f"recreating {path}")
+            self.connection.execute("DROP TABLE IF EXISTS definitions")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def getKey(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def sync(self, paths):
+        """Bring the bundle in line with the given files and return the
+        hash of each one's content, by path."""
+        stored = {key: (size, mtime, digest) for key, size, mtime, digest in
+                  self.connection.execute(
+                      "SELECT path, size, mtime, hash FROM definitions")}
+
+        digests = {}
+        updated = 0
+        with self.connection:
+            for path in paths:
+                key = self.getKey(path)
+                fileStat = os.stat(path)
+                row = stored.pop(key, None)
+                if row is not None and \
+                        row[:2] == (fileStat.st_size, fileStat.st_mtime_ns):
+                    digests[path] = row[2]
+                    continue
+
+                with open(path, 'rb') as f:
+                    content = f.read()
+                digests[path] = hashlib.sha256(content).hexdigest()
+                text = content.decode()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO definitions VALUES (?, ?, ?, ?, "
+                    "?, ?)", (key, getPrimaryName(text), fileStat.st_size,
+                              fileStat.st_mtime_ns, digests[path], text))
+                updated += 1
+
+            self.connection.executemany(
+                "DELETE FROM definitions WHERE path = ?",
+                ((key,) for key in stored))
+
+        LOGGER.debug(f"updated {updated} and removed {len(stored)} "
+                     f"definitions in {self.path}")
+        return digests
+
+    def read(self, path):
+        """Return the JSON text of the definition at path."""
+        row = self.connection.execute(
+            "SELECT data FROM definitions WHERE path = ?",
+            (self.getKey(path),)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return row[0]
+
+    def find(self, name):
+        """Return the path and JSON text of the definition whose primary name
+        is name, or None."""
+        row = self.connection.execute(
+            "SELECT path, data FROM definitions WHERE name = ? "
+            "ORDER BY path LIMIT 1", (name,)).fetchone()
+        if row is None:
+            return None
+        return os.path.join(self.root, *row[0].split("/")), row[1]
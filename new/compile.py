@@ -1,157 +1,2089 @@
-import copy
+"""Builds the site from the definitions, templates, images and audio.
+
+Importing this module does nothing but define the build. Call build() (or
+main(), which also loads the templates and writes reports) with a
+BuildConfig, or run it from the command line. Modules that only some
+options need are imported when they are first used.
+"""
+import functools
+import hashlib
+import importlib.util
+import itertools
 import json
 import logging
+import math
 import os
 import shutil
+import stat
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import quote
 
-from jinja2 import Template
+import imaging
+import model
+import mp3info
+from model import IndexName
 
 letters = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l",
            "m", "n", "o", "p", "q", "r", "s", "t", "u", "v", "w", "x", "y", "z"]
 
+BUILD_DIR = "build"
+# Builds are written here and swapped in for BUILD_DIR once they succeed,
+# so whatever is being served is never half built
+STAGING_DIR = "build.staging"
+# Where the live build waits while the staged one is renamed into its place,
+# when they can't be exchanged at once
+PREVIOUS_DIR = STAGING_DIR + ".old"
+DEFINITIONS_DIR = "definitions"
+TEMPLATES_DIR = "templates"
+IMAGES_DIR = "images"
+AUDIO_DIR = "audio"
+ASSET_DIRS = (IMAGES_DIR, AUDIO_DIR)
+# Resized copies of the images, inside the build
+DERIVED_DIR = "derived"
+
+TEMPLATE_NAMES = ("stop.html", "missing.html", "index.html", "landing.html",
+                  "letter.html")
+
+# "single" renders every name into index.html, "sharded" renders a small
+# landing page at index.html and one index-<letter>.html page per letter
+INDEX_MODES = ("single", "sharded")
+
+# Build state that is not part of the site, such as the template caches
+CACHE_DIR = ".cache"
+BYTECODE_CACHE_DIR = os.path.join(CACHE_DIR, "templates")
+PRECOMPILED_DIR = os.path.join(CACHE_DIR, "precompiled")
+AUDIO_CACHE = os.path.join(CACHE_DIR, "audio.json")
+AUDIO_CACHE_VERSION = 1
+IMAGE_CACHE = os.path.join(CACHE_DIR, "images.json")
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "images")
+IMAGE_CACHE_VERSION = 1
+# Every definition in one file, synced from DEFINITIONS_DIR on each build
+BUNDLE_FILE = os.path.join(CACHE_DIR, "definitions.sqlite")
+# Hashes of the assets in the build, for fingerprinting their URLs
+FINGERPRINT_CACHE = os.path.join(CACHE_DIR, "fingerprints.json")
+FINGERPRINT_CACHE_VERSION = 1
+
+# The manifest lives inside the build so that it always describes
+# the outputs sitting next to it. Outputs are recorded relative to the build.
+MANIFEST_FILE = ".manifest.json"
+MANIFEST_VERSION = 12
+# Which stop pages link to which, kept next to the manifest
+GRAPH_FILE = ".graph.json"
+SITEMAP_FILE = "sitemap.xml"
+# Which outputs were added, changed or removed since the previous build,
+# for deploying only those
+DEPLOY_FILE = ".deploy.json"
+# Records of the build itself rather than parts of the site
+BUILD_RECORDS = (MANIFEST_FILE, GRAPH_FILE, DEPLOY_FILE)
+
+# Where pages can take their date from instead of the time of the build
+DATE_SOURCES = ("mtime", "git")
+
+# Fingerprinted asset URLs end in "?v=" and this many characters of the
+# hash of the asset's content, so they can be cached indefinitely
+FINGERPRINT_LENGTH = 12
+
+# Ways of putting asset files into the build, cheapest first.
+# Each one falls back to the next if the filesystem does not support it.
+STAGING_MODES = ("reflink", "hardlink", "symlink", "copy")
+
+# Compressed siblings written next to pages for servers to send as they are.
+# brotli is only used when its module is installed.
+COMPRESSION_FORMATS = {'gzip': ".gz", 'brotli': ".br"}
+PRECOMPRESS_EXTENSIONS = (".html",)
+
+# ioctl request for cloning a file's extents on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# renameat2() arguments for swapping two paths in one step on Linux
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# Directories that watch mode rebuilds on changes to, and how often it
+# looks at them, in seconds
+WATCHED_DIRS = (DEFINITIONS_DIR, TEMPLATES_DIR, IMAGES_DIR, AUDIO_DIR)
+WATCH_INTERVAL = 0.2
+# Pages served in watch mode poll this path for the number of the current
+# build, and reload when it changes
+RELOAD_PATH = "/__build"
+RELOAD_SCRIPT = """<script>
+(function () {
+    var build = null;
+    setInterval(function () {
+        fetch("%s", {cache: "no-store"}).then(function (response) {
+            return response.text();
+        }).then(function (current) {
+            if (build !== null && current !== build) {
+                location.reload();
+            }
+            build = current;
+        }).catch(function () {});
+    }, 500);
+})();
+</script>
+""" % RELOAD_PATH
+
+# What to build and how. The defaults make the same full build as running
+# compile.py without any options. root is the directory with the
+# definitions, templates, images and audio, the current one if not given.
+BuildConfig = namedtuple(
+    'BuildConfig', 'incremental assetMode jobs precompile indexMode '
+    'precompress fingerprint siteURL dateSource minify onlyReferenced root',
+    defaults=(False, "copy", 1, False, "single", (), False, None, None, False,
+              False, None))
+BuildResult = namedtuple('BuildResult', 'manifest missing assets')
+
 
 LOGGER = logging.getLogger(__name__)
 
 
+# The same few thousand names go through these again and again
+@functools.lru_cache(maxsize=None)
 def getLetter(name):
     return name[0].lower()
 
 
+@functools.lru_cache(maxsize=None)
 def getNameURL(name):
     return name.replace(" ", "_")
 
 
-logging.basicConfig(level=logging.DEBUG)
+# The directory the paths above are relative to, as set by useProject()
+projectDir = ""
 
+# Loaded from the templates of projectDir
+templates = {}
 
-stopTemplateFile = open(os.path.join("templates", "stop.html"), 'r')
-stopTemplate = Template(stopTemplateFile.read())
-stopTemplateFile.close()
+# Metadata of every clip in AUDIO_DIR, by "<organ>/<file>"
+audioInfo = {}
+# Size and derivatives of every image in IMAGES_DIR, by "<letter>/<file>"
+imageInfo = {}
+# Name and output of the definitions linking to each stop page, by output
+referrers = {}
+# URL of each asset, by its path in the build, when fingerprinting them
+assetURLs = {}
+# When each definition and template last changed, by path, when pages are
+# dated by their sources
+sourceDates = {}
+# Content hash of each image and clip, by its path in the build
+assetHashes = {}
+# Definitions read while summarizing them, by path, so that rendering them
+# later in the same build doesn't read and check them again
+loadedStops = {}
+# The open definitions bundle of each process, as forked workers can't
+# share their parent's connection. Each is reopened once builds move to
+# another bundle file, such as another project's.
+bundles = {}
 
-indexTemplateFile = open(os.path.join("templates", "index.html"), 'r')
-indexTemplate = Template(indexTemplateFile.read())
-indexTemplateFile.close()
 
-missingTemplateFile = open(os.path.join("templates", "missing.html"), 'r')
-missingTemplate = Template(missingTemplateFile.read())
-missingTemplateFile.close()
+def projectPath(*parts):
+    return os.path.join(projectDir, *parts)
 
-if os.path.exists("build"):
-    shutil.rmtree("build")
 
-os.makedirs("build")
-shutil.copytree("images", os.path.join("build", "images"))
-shutil.copytree("audio", os.path.join("build", "audio"))
+def getProjectKey(path):
+    """Return the path relative to projectDir, as paths are recorded."""
+    return os.path.relpath(path, projectPath(os.curdir))
 
-names = []
 
+def useProject(root):
+    """Resolve paths against root, or the current directory if it's None,
+    from now on. Templates loaded from another project are dropped."""
+    global projectDir
 
-def getNames(letter):
-    letterNames = []
-    for name in names:
-        if getLetter(name["name"]) == letter:
-            letterNames.append(name)
-    return letterNames
+    root = root or ""
+    if root != projectDir:
+        projectDir = root
+        templates.clear()
 
 
-for subdir, dirs, files in os.walk("definitions"):
-    for file in files:
-        LOGGER.debug(f"compiling data from {file}")
-        with open(os.path.join(subdir, file)) as definition:
-            try:
-                data = json.load(definition)
-            except json.decoder.JSONDecodeError:
-                LOGGER.error(f"could not parse {file}")
-                continue
+def createEnvironment(precompile=False):
+    from jinja2 import (Environment, FileSystemBytecodeCache,
+                        FileSystemLoader, ModuleLoader)
+
+    loader = FileSystemLoader(projectPath(TEMPLATES_DIR))
+    os.makedirs(projectPath(BYTECODE_CACHE_DIR), exist_ok=True)
+    environment = Environment(
+        loader=loader, bytecode_cache=FileSystemBytecodeCache(
+            projectPath(BYTECODE_CACHE_DIR)), auto_reload=False)
+
+    if not precompile:
+        return environment
+
+    # Precompiled modules are never checked against their sources,
+    # so keep them in a directory named after the templates they came from
+    digest = hashBytes("".join(
+        hashFile(projectPath(TEMPLATES_DIR, template))
+        for template in TEMPLATE_NAMES).encode())
+    precompiled = projectPath(PRECOMPILED_DIR)
+    target = os.path.join(precompiled, digest)
+    if not os.path.exists(target):
+        LOGGER.debug(f"precompiling templates to {target}")
+        if os.path.exists(precompiled):
+            shutil.rmtree(precompiled)
+        environment.compile_templates(target + ".tmp", zip=None)
+        os.replace(target + ".tmp", target)
+
+    environment.loader = ModuleLoader(target)
+    return environment
+
+
+def loadTemplates(precompile=False):
+    environment = createEnvironment(precompile)
+    for template in TEMPLATE_NAMES:
+        templates[template] = environment.get_template(template)
+
 
-            if 'names' not in data:
+def initWorker(root, precompile, audio, images, backlinks, urls, dates):
+    # Forked workers already have these, but spawned ones don't
+    useProject(root)
+    loadTemplates(precompile)
+    audioInfo.update(audio)
+    imageInfo.update(images)
+    referrers.update(backlinks)
+    assetURLs.update(urls)
+    sourceDates.update(dates)
+
+
+def getImageInfo(key):
+    # The old site showed "<name>$.<extension>" as the thumbnail of
+    # "<name>.<extension>", of which only the latter is kept
+    info = imageInfo.get(key)
+    if info is None:
+        info = imageInfo.get(key.replace("$", ""))
+    return info
+
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}:{seconds:02}"
+
+
+def formatSize(size):
+    if size < 1 << 20:
+        return f"{size / 1024:.0f} KB"
+    return f"{size / (1 << 20):.1f} MB"
+
+
+class NameIndex:
+    """Every name shown on the index, deduplicated and bucketed by letter."""
+
+    def __init__(self):
+        self.names = []
+        self.keys = set()
+        self.letters = {}
+        # Links of the names that point at stops without a definition
+        self.missing = set()
+
+    def __contains__(self, name):
+        return name in self.keys
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        if name in self.keys:
+            return False
+        self.keys.add(name)
+        self.names.append(name)
+        return True
+
+    def merge(self, groups):
+        # The rest of a group is only considered if its first name is new.
+        # Groups read back from the manifest are lists rather than records.
+        for group in groups:
+            if IndexName._make(group[0]) in self:
                 continue
+            for newName in group:
+                self.add(IndexName._make(newName))
+
+    def sort(self):
+        self.names.sort(key=lambda name: name.name)
+        self.letters = {}
+        for name in self.names:
+            self.letters.setdefault(getLetter(name.name), []).append(name)
+
+    def getNames(self, letter):
+        return self.letters.get(letter, [])
+
+    def getColumns(self, letter, count):
+        letterNames = self.getNames(letter)
+        size = math.ceil(len(letterNames) / count)
+        return [letterNames[i:i+size]
+                for i in range(0, len(letterNames), size or 1)]
+
+
+class BuildStats:
+    """Wall time and peak memory of each build phase, and time per page.
+
+    Phases nest (every "write" happens inside another phase), so their
+    times overlap rather than add up to the length of the build.
+    """
+
+    def __init__(self, traceMemory=False):
+        self.traceMemory = traceMemory
+        self.phases = {}
+        self.pages = {}
+        self.open = []
+
+    def foldPeak(self):
+        # tracemalloc only has one peak, so hand it to every open phase
+        # before resetting it for the next one
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self.open:
+            entry['peak'] = max(entry['peak'], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name):
+        if self.traceMemory:
+            self.foldPeak()
+        entry = {'peak': 0}
+        self.open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if self.traceMemory:
+                self.foldPeak()
+            self.open.pop()
+            self.add(name, seconds, entry['peak'])
+
+    def add(self, name, seconds, peakMemory=0, calls=1):
+        phase = self.phases.setdefault(
+            name, {'seconds': 0, 'calls': 0, 'peakMemory': 0})
+        phase['seconds'] += seconds
+        phase['calls'] += calls
+        phase['peakMemory'] = max(phase['peakMemory'], peakMemory)
+
+    def recordPage(self, page, seconds):
+        self.pages[page] = self.pages.get(page, 0) + seconds
+
+    def merge(self, other):
+        for name, phase in other.phases.items():
+            self.add(name, phase['seconds'], phase['peakMemory'],
+                     phase['calls'])
+        for page, seconds in other.pages.items():
+            self.recordPage(page, seconds)
+
+    def report(self, top=10):
+        slowest = sorted(self.pages.items(), key=lambda k: k[1],
+                         reverse=True)[:top]
+        return {
+            'phases': {name: dict(phase, seconds=round(phase['seconds'], 6))
+                       for name, phase in self.phases.items()},
+            'pages': {page: round(seconds, 6)
+                      for page, seconds in sorted(self.pages.items())},
+            'slowestPages': [{'page': page, 'seconds': round(seconds, 6)}
+                             for page, seconds in slowest],
+        }
+
+
+def hashBytes(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def hashFile(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashTree(root):
+    # Asset trees are large, so fingerprint them by path, size and mtime
+    # rather than reading every byte on every build
+    digest = hashlib.sha256()
+    for subdir, dirs, files in os.walk(root):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(subdir, file)
+            stat = os.stat(path)
+            digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n"
+                          .encode())
+    return digest.hexdigest()
+
+
+def listDefinitions():
+    paths = []
+    for subdir, dirs, files in os.walk(projectPath(DEFINITIONS_DIR)):
+        dirs.sort()
+        for file in sorted(files):
+            # Skip editor and converter bookkeeping such as .DS_Store
+            if not file.startswith("."):
+                paths.append(getProjectKey(os.path.join(subdir, file)))
+    return paths
+
+
+def stagingPath(*parts):
+    return projectPath(STAGING_DIR, *parts)
+
+
+def writePage(output, content, stats):
+    path = stagingPath(output)
+    with stats.phase("write"):
+        # Staged outputs may be hard links into the live build,
+        # so they are replaced rather than written through
+        try:
+            f = open(path + ".tmp", "w")
+        except FileNotFoundError:
+            # Another worker may be making the same directory
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path + ".tmp", "w")
+        with f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+
+
+def removeOutput(path):
+    if os.path.lexists(path):
+        LOGGER.debug(f"removing stale output {path}")
+        os.remove(path)
+
+
+def loadManifest():
+    try:
+        with open(projectPath(BUILD_DIR, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def saveManifest(manifest):
+    path = stagingPath(MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        # dumps() goes through the C encoder, dump() does not
+        f.write(json.dumps(manifest))
+    os.replace(path + ".tmp", path)
+
+
+def getPrimaryName(stop, file=None):
+    # Without a file name, problems are not logged again
+    data_names = [item.name.strip() for item in stop.names if item.primary]
+    if not data_names:
+        if file is not None:
+            LOGGER.warning(f"{file} did not have a primary name")
+        return stop.names[0].name
+
+    elif len(data_names) > 1 and file is not None:
+        LOGGER.warning(f"{file} had multiple primary names")
+
+    return data_names[0]
+
+
+def getBundle():
+    import bundle
+
+    pid = os.getpid()
+    path = os.path.abspath(projectPath(BUNDLE_FILE))
+    if pid in bundles and bundles[pid].path != path:
+        bundles.pop(pid).close()
+    if pid not in bundles:
+        bundles[pid] = bundle.Bundle(
+            path, os.path.abspath(projectPath(DEFINITIONS_DIR)))
+    return bundles[pid]
+
+
+def loadDefinition(path):
+    return model.loadStop(json.loads(getBundle().read(projectPath(path))))
+
+
+def getOutput(name):
+    return os.path.join(getLetter(name), getNameURL(name)+".html")
+
+
+def getLinks(stop):
+    """Return the stop pages and the organs a definition links to."""
+    links = {getOutput(item.link)
+             for item in stop.names + stop.variants + stop.comparisons
+             if item.link != ""}
+    organs = {clip.organLink for division in stop.soundClips
+              for clip in division.clips}
+    return sorted(links), sorted(organs)
+
+
+def getAssets(stop, letter):
+    """Return the clips and images a definition refers to, by their paths
+    under AUDIO_DIR and IMAGES_DIR."""
+    clips = [f"{clip.organLink}/{clipFile.file}"
+             for division in stop.soundClips for clip in division.clips
+             for clipFile in clip.files]
+    images = [f"{letter}/{image.file}" for image in stop.images]
+    return clips, images
+
+
+def emptyEntry(date=None):
+    return {'name': None, 'names': [], 'outputs': [], 'links': [],
+            'organs': [], 'clips': {}, 'images': {}, 'assets': {},
+            'referrers': [], 'date': date}
+
+
+def summarizeDefinition(path):
+    """Read just what the link graph needs from a definition."""
+    summary = emptyEntry()
+    try:
+        stop = loadDefinition(path)
+    except ValueError:
+        return summary
+
+    loadedStops[path] = stop
+    if stop.names:
+        summary['name'] = getPrimaryName(stop)
+        summary['outputs'] = [getOutput(summary['name'])]
+        summary['links'], summary['organs'] = getLinks(stop)
+        clips, images = getAssets(stop, getLetter(summary['name']))
+        summary['clips'] = dict.fromkeys(clips)
+        summary['images'] = dict.fromkeys(images)
+    return summary
 
-            data_names = [item['name'].strip() for item in data['names']
-                          if item['primary']]
-            if not data_names:
-                LOGGER.warning(f"{file} did not have a primary name")
-                name = data['names'][0]['name']
 
-            elif len(data_names) > 1:
-                LOGGER.warning("f{file} had multiple primary names")
-                name = data_names[0]
+def buildGraph(paths, summaries):
+    """Fill in referrers from which pages each definition links to."""
+    referrers.clear()
+    for path in paths:
+        summary = summaries[path]
+        for output in summary['outputs']:
+            for link in summary['links']:
+                if link != output:
+                    referrers.setdefault(link, []).append(
+                        {'name': summary['name'], 'output': output})
 
+    for output, pageReferrers in referrers.items():
+        unique = {referrer['output']: referrer for referrer in pageReferrers}
+        referrers[output] = sorted(unique.values(),
+                                   key=lambda referrer: referrer['name'])
+
+    graph = {'stops': {}, 'organs': {}, 'referrers': referrers}
+    for path in paths:
+        summary = summaries[path]
+        for output in summary['outputs']:
+            graph['stops'][output] = {'name': summary['name'],
+                                      'definition': path,
+                                      'links': summary['links'],
+                                      'organs': summary['organs']}
+            for organ in summary['organs']:
+                graph['organs'].setdefault(organ, []).append(output)
+
+    path = stagingPath(GRAPH_FILE)
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps(graph))
+    os.replace(path + ".tmp", path)
+
+
+def collectNames(stop, name):
+    # Names are returned as groups: the first entry of a group is only
+    # added to the index if it is new, and the rest of the group is only
+    # considered when the first entry was actually added.
+    groups = []
+
+    for item in stop.names:
+        if item.link != "":
+            groups.append((IndexName(item.name, item.link),
+                           IndexName(item.name + " ("+name+")", name)))
+        else:
+            groups.append((IndexName(item.name, name),))
+
+    for item in stop.variants + stop.comparisons:
+        if item.link != "":
+            if item.link != item.name:
+                groups.append((IndexName(item.name + " ("+item.link+")",
+                                         item.link),))
             else:
-                name = data_names[0]
-
-            for nameItem in data['names']:
-                newName = copy.deepcopy(nameItem)
-                del newName['primary']
-                del newName['origin']
-                if newName['link'] != "":
-                    if newName not in names:
-                        names.append(newName)
-                        newNewName = copy.deepcopy(newName)
-                        newNewName['name'] = newNewName['name'] + " ("+name+")"
-                        newNewName['link'] = name
-                        if newNewName not in names:
-                            names.append(newNewName)
-                else:
-                    newName['link'] = name
-                    if newName not in names:
-                        names.append(newName)
-
-            for nameItem in data['variants']:
-                newName = copy.deepcopy(nameItem)
-                if newName['link'] != "":
-                    if newName['link'] != newName['name']:
-                        newNewName = copy.deepcopy(newName)
-                        newNewName['name'] = newNewName['name'] + \
-                            " ("+newNewName['link']+")"
-                        if newNewName not in names:
-                            names.append(newNewName)
-                    else:
-                        if newName not in names:
-                            names.append(newName)
-
-            for nameItem in data['comparisons']:
-                newName = copy.deepcopy(nameItem)
-                if newName['link'] != "":
-                    if newName['link'] != newName['name']:
-                        newNewName = copy.deepcopy(newName)
-                        newNewName['name'] = newNewName['name'] + \
-                            " ("+newNewName['link']+")"
-                        if newNewName not in names:
-                            names.append(newNewName)
-                    else:
-                        if newName not in names:
-                            names.append(newName)
-
-            nameURL = getNameURL(name)
-            letter = getLetter(name)
-            if not os.path.exists(os.path.join("build", letter)):
-                os.makedirs(os.path.join("build", letter))
-            f = open(os.path.join("build", letter, nameURL+".html"), "w")
-            f.write(stopTemplate.render(data, name=name, letter=letter,
-                                        nameURL=nameURL, getNameURL=getNameURL,
-                                        getLetter=getLetter,
-                                        date=datetime.utcnow()))
-            f.close()
-
-
-names = sorted(names, key=lambda k: k['name'])
-
-for name in names:
-    if not os.path.exists(os.path.join("definitions", getLetter(name['link']), getNameURL(name['link'])+".json")):
-        if not os.path.exists(os.path.join("build", getLetter(name['link']))):
-            os.makedirs(os.path.join("build", getLetter(name['link'])))
-        f = open(os.path.join("build", getLetter(
-            name['link']), getNameURL(name['link'])+".html"), "w")
-        f.write(missingTemplate.render(name=name, getNameURL=getNameURL,
-                                       getLetter=getLetter, date=datetime.utcnow()))
-        f.close()
-        name['exists'] = False
+                groups.append((IndexName(item.name, item.link),))
+
+    return groups
+
+
+def compileDefinition(path, date, stats):
+    start = time.perf_counter()
+    date = getPageDate(date, path)
+    file = os.path.basename(path)
+    LOGGER.debug(f"compiling data from {file}")
+    with stats.phase("load"):
+        try:
+            stop = loadedStops.pop(path, None) or loadDefinition(path)
+        except json.decoder.JSONDecodeError:
+            LOGGER.error(f"could not parse {file}")
+            return emptyEntry(date.isoformat())
+        except model.InvalidDefinition as e:
+            LOGGER.error(f"{file} is not a valid definition: {e}")
+            return emptyEntry(date.isoformat())
+
+    if not stop.names:
+        return emptyEntry(date.isoformat())
+
+    with stats.phase("names"):
+        name = getPrimaryName(stop, file)
+        groups = collectNames(stop, name)
+
+    nameURL = getNameURL(name)
+    letter = getLetter(name)
+    output = getOutput(name)
+    links, organs = getLinks(stop)
+    pageReferrers = referrers.get(output, [])
+
+    clipKeys, imageKeys = getAssets(stop, letter)
+    clips = {key: audioInfo.get(key) for key in clipKeys}
+    images = {key: getImageInfo(key) for key in imageKeys}
+
+    # The URLs the page links its assets by, to rerender it when they change
+    assets = {}
+
+    def assetURL(path):
+        assets[path] = assetURLs.get(path, path)
+        return assets[path]
+
+    with stats.phase("render"):
+        page = templates["stop.html"].render(
+            stop._asdict(), name=name, letter=letter, nameURL=nameURL,
+            getNameURL=getNameURL, getLetter=getLetter,
+            formatDuration=formatDuration, formatSize=formatSize,
+            clipInfo=clips, imageInfo=images, assetURL=assetURL,
+            referrers=pageReferrers, date=date)
+    writePage(output, page, stats)
+
+    stats.recordPage(output, time.perf_counter() - start)
+    return {'name': name, 'names': groups, 'outputs': [output],
+            'links': links, 'organs': organs, 'clips': clips,
+            'images': images, 'assets': assets, 'referrers': pageReferrers,
+            'date': date.isoformat()}
+
+
+def compileDefinitionInWorker(path, date):
+    # Workers time themselves and hand their stats back to the parent
+    stats = BuildStats()
+    return compileDefinition(path, date, stats), stats
+
+
+def loadCache(path, version):
+    try:
+        with open(projectPath(path)) as f:
+            cache = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+
+    if cache.get('version') != version:
+        return None
+
+    return cache
+
+
+def saveCache(path, cache):
+    path = projectPath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps(cache))
+    os.replace(path + ".tmp", path)
+
+
+def hashFiles(paths, cached):
+    """Hash each file, reusing the hashes in cached (as returned before)
+    for files whose size and mtime did not change."""
+    files = {}
+    for path in paths:
+        fileStat = os.stat(path)
+        entry = cached.get(path)
+        if entry is not None and entry['size'] == fileStat.st_size and \
+                entry['mtime'] == fileStat.st_mtime_ns:
+            digest = entry['hash']
+        else:
+            digest = hashFile(path)
+        files[path] = {'size': fileStat.st_size,
+                       'mtime': fileStat.st_mtime_ns, 'hash': digest}
+    return files
+
+
+def mapInWorkers(function, jobs, *iterables):
+    items = list(zip(*iterables))
+    if jobs == 1 or len(items) < 2:
+        return [function(*item) for item in items]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunksize = max(1, len(items) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, *zip(*items),
+                                 chunksize=chunksize))
+
+
+def listFiles(root, extensions=None):
+    paths = []
+    for subdir, dirs, files in os.walk(root):
+        dirs.sort()
+        for file in sorted(files):
+            if extensions is None or file.lower().endswith(extensions):
+                paths.append(os.path.join(subdir, file))
+    return paths
+
+
+def getAssetKey(path, root):
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+def loadAudioInfo(jobs):
+    """Read the metadata of every clip, reusing what was read for files
+    with the same content before."""
+    cache = loadCache(AUDIO_CACHE, AUDIO_CACHE_VERSION) or \
+        {'files': {}, 'info': {}}
+    files = hashFiles(listFiles(projectPath(AUDIO_DIR), (".mp3",)),
+                      cache['files'])
+
+    pending = {}
+    for path, file in files.items():
+        if file['hash'] not in cache['info']:
+            pending.setdefault(file['hash'], path)
+
+    info = dict(cache['info'])
+    info.update(zip(pending, mapInWorkers(mp3info.read, jobs,
+                                          pending.values())))
+    LOGGER.debug(f"read {len(pending)} of {len(files)} audio files")
+
+    # Only keep metadata of files that still exist
+    info = {file['hash']: info[file['hash']] for file in files.values()}
+    saveCache(AUDIO_CACHE, {'version': AUDIO_CACHE_VERSION, 'files': files,
+                            'info': info})
+
+    audioInfo.clear()
+    for path, file in files.items():
+        audioInfo[getAssetKey(path, projectPath(AUDIO_DIR))] = \
+            info[file['hash']]
+        assetHashes[getAssetKey(path, projectPath(os.curdir))] = file['hash']
+
+
+def loadImageInfo(jobs):
+    """Make the derivatives of every image that don't exist yet, and return
+    which cached derivative goes where in the build."""
+    imageInfo.clear()
+    cache = loadCache(IMAGE_CACHE, IMAGE_CACHE_VERSION) or \
+        {'files': {}, 'info': {}}
+    files = hashFiles(listFiles(projectPath(IMAGES_DIR)), cache['files'])
+    for path, file in files.items():
+        assetHashes[getAssetKey(path, projectPath(os.curdir))] = file['hash']
+
+    if not imaging.isAvailable():
+        LOGGER.info("Pillow is not installed, images are used as they are")
+        saveCache(IMAGE_CACHE, dict(cache, files=files))
+        return {}
+
+    cacheDir = projectPath(IMAGE_CACHE_DIR)
+
+    def getCachePath(digest, name, variant):
+        return os.path.join(cacheDir,
+                            f"{digest}-{name}.{variant['extension']}")
+
+    # Derivatives are made once per distinct image content
+    pending = {}
+    for path, file in files.items():
+        info = cache['info'].get(file['hash'], False)
+        if info is False or info is not None and not all(
+                os.path.exists(getCachePath(file['hash'], name, variant))
+                for name, variant in info['variants'].items()):
+            pending.setdefault(file['hash'], path)
+
+    os.makedirs(cacheDir, exist_ok=True)
+    info = dict(cache['info'])
+    info.update(zip(pending, mapInWorkers(
+        imaging.makeDerivatives, jobs, pending.values(),
+        (os.path.join(cacheDir, digest) for digest in pending))))
+    LOGGER.debug(f"resized {len(pending)} of {len(files)} images")
+
+    info = {file['hash']: info[file['hash']] for file in files.values()}
+    saveCache(IMAGE_CACHE, {'version': IMAGE_CACHE_VERSION, 'files': files,
+                            'info': info})
+
+    derived = {}
+    for path, file in files.items():
+        if info[file['hash']] is None:
+            continue
+
+        key = getAssetKey(path, projectPath(IMAGES_DIR))
+        stem = os.path.splitext(key)[0]
+        variants = {}
+        for name, variant in info[file['hash']]['variants'].items():
+            output = f"{DERIVED_DIR}/{stem}-{name}.{variant['extension']}"
+            derived[output] = getCachePath(file['hash'], name, variant)
+            variants[name] = {'file': output, 'width': variant['width'],
+                              'height': variant['height']}
+
+        # Variants no smaller than the one before are left out of srcset
+        srcset = []
+        for variant in variants.values():
+            if not srcset or variant['width'] > srcset[-1]['width']:
+                srcset.append(variant)
+
+        imageInfo[key] = {'width': info[file['hash']]['width'],
+                          'height': info[file['hash']]['height'],
+                          'variants': variants, 'srcset': srcset}
+
+    # Cached derivatives of images that no longer exist
+    used = set(derived.values())
+    for path in listFiles(cacheDir):
+        if path not in used:
+            os.remove(path)
+
+    return derived
+
+
+def stageDerivatives(manifest, derived):
+    for output, source in derived.items():
+        target = stagingPath(output)
+        if os.path.exists(target) and os.path.samefile(source, target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        removeOutput(target)
+        linkOrCopy(source, target)
+    manifest['derived'] = sorted(derived)
+
+
+def reportClips(manifest):
+    """Warn about clips that definitions refer to but can't be played."""
+    problems = 0
+    for path, entry in manifest['definitions'].items():
+        for key, info in entry['clips'].items():
+            problem = mp3info.getProblem(info)
+            if problem is not None:
+                LOGGER.warning(f"{path} refers to "
+                               f"{AUDIO_DIR}/{key}, which is {problem}")
+                problems += 1
+    if problems:
+        LOGGER.warning(f"{problems} sound clips can't be played")
+
+
+def listAssets():
+    """Return the path of every file in ASSET_DIRS, as it is in the build.
+    """
+    return {getAssetKey(path, projectPath(os.curdir))
+            for assetDir in ASSET_DIRS
+            for path in listFiles(projectPath(assetDir))}
+
+
+def resolveReferences(summaries, assets):
+    """Find the files that the clips, images and organs of definitions
+    refer to.
+
+    Returns the definitions referring to each existing asset and to each
+    missing one, by the asset's path in the build.
+    """
+    referenced = {}
+    missing = {}
+
+    def refer(candidates, path):
+        for asset in candidates:
+            if asset in assets:
+                referenced.setdefault(asset, []).append(path)
+                return
+        missing.setdefault(candidates[0], []).append(path)
+
+    # An organ's page and its images, as opposed to its clips, go with
+    # every definition linking to the organ
+    organPages = {}
+    for asset in assets:
+        parts = asset.split("/")
+        if parts[0] == AUDIO_DIR and len(parts) > 2 and \
+                not asset.endswith(".mp3"):
+            organPages.setdefault(parts[1], []).append(asset)
+
+    for path, summary in summaries.items():
+        for organ in summary['organs']:
+            for asset in organPages.get(organ, []):
+                referenced.setdefault(asset, []).append(path)
+        for key in summary['clips']:
+            refer([f"{AUDIO_DIR}/{key}"], path)
+        for key in summary['images']:
+            # See getImageInfo()
+            refer([f"{IMAGES_DIR}/{key}",
+                   f"{IMAGES_DIR}/{key.replace('$', '')}"], path)
+    return referenced, missing
+
+
+def auditAssets(assets, referenced, missing):
+    """Report the assets that no definition refers to, those that are
+    referred to but don't exist, and those with the same content."""
+    contents = {}
+    for asset in sorted(assets):
+        if asset in assetHashes:
+            contents.setdefault(assetHashes[asset], []).append(asset)
+    duplicates = [group for group in contents.values() if len(group) > 1]
+
+    audit = {
+        'unreferenced': sorted(assets - referenced.keys()),
+        'missing': [{'asset': asset, 'definitions': sorted(paths)}
+                    for asset, paths in sorted(missing.items())],
+        'duplicates': duplicates,
+    }
+    LOGGER.info(f"{len(referenced)} of {len(assets)} assets are referred "
+                f"to, {len(audit['unreferenced'])} are not")
+    if missing:
+        LOGGER.warning(f"{len(missing)} assets are referred to but missing")
+    if duplicates:
+        LOGGER.info(f"{sum(map(len, duplicates))} assets have the same "
+                    f"content as another, in {len(duplicates)} groups")
+    return audit
+
+
+def fingerprintAssets(manifest):
+    """Give every staged image, clip and derivative a URL that changes
+    with its content."""
+    cache = loadCache(FINGERPRINT_CACHE, FINGERPRINT_CACHE_VERSION) or \
+        {'files': {}}
+    paths = []
+    for root in ASSET_DIRS + (DERIVED_DIR,):
+        paths.extend(listFiles(stagingPath(root)))
+    files = hashFiles(paths, cache['files'])
+    saveCache(FINGERPRINT_CACHE, {'version': FINGERPRINT_CACHE_VERSION,
+                                  'files': files})
+
+    assetURLs.clear()
+    for path, file in files.items():
+        output = getAssetKey(path, stagingPath())
+        assetURLs[output] = f"{output}?v={file['hash'][:FINGERPRINT_LENGTH]}"
+    manifest['fingerprints'] = dict(assetURLs)
+
+
+def stageFile(source, target, method):
+    if method == "reflink":
+        import fcntl
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            os.remove(target)
+            raise
+        shutil.copystat(source, target)
+
+    elif method == "hardlink":
+        os.link(source, target)
+
+    elif method == "symlink":
+        os.symlink(os.path.abspath(source), target)
+
+    else:
+        shutil.copy2(source, target)
+
+
+def isStaged(sourceStat, target, method):
+    try:
+        targetStat = os.lstat(target)
+    except FileNotFoundError:
+        return False
+
+    # Switching to or from symlinks always restages the file
+    if stat.S_ISLNK(targetStat.st_mode) != (method == "symlink"):
+        return False
+
+    targetStat = os.stat(target)
+    return targetStat.st_size == sourceStat.st_size and \
+        targetStat.st_mtime_ns == sourceStat.st_mtime_ns
+
+
+def stageTree(source, target, methods, counts, keep=None):
+    """Mirror source at target, leaving out the files whose path in the
+    build is not in keep, if given."""
+    staged = set()
+
+    for subdir, dirs, files in os.walk(source):
+        targetDir = os.path.join(target, os.path.relpath(subdir, source))
+        os.makedirs(targetDir, exist_ok=True)
+        for file in files:
+            sourceFile = os.path.join(subdir, file)
+            if keep is not None and \
+                    getAssetKey(sourceFile, ".") not in keep:
+                continue
+            targetFile = os.path.join(targetDir, file)
+            staged.add(targetFile)
+            sourceStat = os.stat(sourceFile)
+            if isStaged(sourceStat, targetFile, methods[0]):
+                counts['unchanged'] += 1
+                continue
+
+            if os.path.lexists(targetFile):
+                os.remove(targetFile)
+
+            while True:
+                try:
+                    stageFile(sourceFile, targetFile, methods[0])
+                    break
+                except (OSError, ImportError) as e:
+                    # Nothing is left to fall back to, so this is a real
+                    # error such as a full disk
+                    if len(methods) == 1:
+                        raise
+                    LOGGER.info(f"could not {methods[0]} {sourceFile} ({e}), "
+                                f"falling back to {methods[1]}")
+                    methods.pop(0)
+
+            counts[methods[0]] += 1
+            if methods[0] == "copy":
+                counts['bytes'] += sourceStat.st_size
+
+    for subdir, dirs, files in os.walk(target, topdown=False):
+        for file in files:
+            if os.path.join(subdir, file) not in staged:
+                removeOutput(os.path.join(subdir, file))
+        if not os.listdir(subdir):
+            os.rmdir(subdir)
+
+
+def copyAssets(previous, manifest, mode, keep=None):
+    counts = dict.fromkeys(STAGING_MODES + ('unchanged', 'bytes'), 0)
+    # Each mode falls back to the easier-to-support ones after it,
+    # and a method that failed once is not retried for the rest of the run
+    methods = list(STAGING_MODES[STAGING_MODES.index(mode):])
+    for assetDir in ASSET_DIRS:
+        fingerprint = {'tree': hashTree(projectPath(assetDir)), 'mode': mode}
+        if keep is not None:
+            fingerprint['keep'] = hashBytes(json.dumps(sorted(
+                asset for asset in keep
+                if asset.startswith(assetDir + "/"))).encode())
+        manifest['assets'][assetDir] = fingerprint
+        target = stagingPath(assetDir)
+        if previous['assets'].get(assetDir) == fingerprint and \
+                os.path.exists(target):
+            LOGGER.debug(f"{assetDir} is unchanged")
+            continue
+
+        stageTree(projectPath(assetDir), target, methods, counts, keep)
+
+    LOGGER.info(f"staged assets: {counts['reflink']} reflinked, "
+                f"{counts['hardlink']} hard linked, "
+                f"{counts['symlink']} symlinked, {counts['copy']} copied, "
+                f"{counts['unchanged']} unchanged, "
+                f"{counts['bytes']} bytes written")
+
+
+def renderDefinitions(paths, date, jobs, precompile, stats):
+    if jobs == 1 or len(paths) < 2:
+        return [compileDefinition(path, date, stats) for path in paths]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    entries = []
+    chunksize = max(1, len(paths) // (jobs * 4))
+    initargs = (projectDir, precompile, audioInfo, imageInfo, referrers,
+                assetURLs, sourceDates)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initWorker,
+                             initargs=initargs) as executor:
+        for entry, workerStats in executor.map(
+                compileDefinitionInWorker, paths, itertools.repeat(date),
+                chunksize=chunksize):
+            entries.append(entry)
+            stats.merge(workerStats)
+    return entries
+
+
+def isUpToDate(path, entry, digest):
+    if entry is None or entry['hash'] != digest:
+        return False
+
+    # Pages dated by their definition show when it last changed
+    if sourceDates and entry['date'] != sourceDates[path].isoformat():
+        return False
+
+    # Pages show the length and size of their clips, and the size and
+    # derivatives of their images
+    if any(audioInfo.get(key) != info
+           for key, info in entry['clips'].items()):
+        return False
+    if any(getImageInfo(key) != info
+           for key, info in entry['images'].items()):
+        return False
+    if any(assetURLs.get(path, path) != url
+           for path, url in entry['assets'].items()):
+        return False
+
+    # And which pages link to them
+    if any(referrers.get(output, []) != entry['referrers']
+           for output in entry['outputs']):
+        return False
+
+    return all(os.path.exists(stagingPath(output))
+               for output in entry['outputs'])
+
+
+def summarizeDefinitions(previous, stats):
+    """Hash every definition, and summarize those that changed since the
+    previous build.
+
+    Returns the paths of the definitions, and their digests and summaries
+    by path.
+    """
+    paths = listDefinitions()
+    with stats.phase("hash"):
+        synced = getBundle().sync([projectPath(path) for path in paths])
+        digests = {path: synced[projectPath(path)] for path in paths}
+
+    loadedStops.clear()
+    summaries = {}
+    for path in paths:
+        entry = previous['definitions'].get(path)
+        # Definitions that did not change link to the same pages
+        # and assets as before
+        if entry is not None and entry['hash'] == digests[path]:
+            summaries[path] = entry
+        else:
+            summaries[path] = summarizeDefinition(path)
+    return paths, digests, summaries
+
+
+def compileDefinitions(previous, manifest, index, paths, digests, summaries,
+                       date, templateChanged, jobs, precompile, stats):
+    with stats.phase("graph"):
+        buildGraph(paths, summaries)
+
+    entries = {}
+    for path in paths:
+        entry = previous['definitions'].get(path)
+        if not templateChanged and isUpToDate(path, entry, digests[path]):
+            entries[path] = entry
+
+    stale = [path for path in paths if path not in entries]
+    for path, entry in zip(stale, renderDefinitions(stale, date, jobs,
+                                                    precompile, stats)):
+        entry['hash'] = digests[path]
+        entries[path] = entry
+    # Workers only emptied their own copies
+    loadedStops.clear()
+
+    # Merging in path order keeps the index identical however many
+    # workers rendered the pages
+    rendered = set(stale)
+    written = set()
+    current = {}
+    for path in paths:
+        manifest['definitions'][path] = entries[path]
+        with stats.phase("names"):
+            index.merge(entries[path]['names'])
+        for output in entries[path]['outputs']:
+            if path in rendered:
+                written.add(output)
+            current.setdefault(output, []).append(path)
+
+    # When several definitions share an output, the last one wins,
+    # as it would when rendering them one after the other
+    for output, owners in current.items():
+        if len(owners) > 1 and output in written:
+            LOGGER.warning(f"{output} is produced by {', '.join(owners)}")
+            compileDefinition(owners[-1], date, stats)
+        current[output] = owners[-1]
+
+    for path, entry in previous['definitions'].items():
+        if path not in manifest['definitions']:
+            LOGGER.debug(f"{path} was removed")
+        for output in entry['outputs']:
+            if output not in current:
+                removeOutput(stagingPath(output))
+
+    return current, written
+
+
+def getDefinitionPath(link):
+    return os.path.join(DEFINITIONS_DIR, getLetter(link),
+                        getNameURL(link)+".json")
+
+
+def findMissing(manifest, index):
+    """Collect the links in the index that have no definition.
+
+    Returns the names to render a missing page for, by output, and how
+    many definitions refer to each of those outputs.
+    """
+    # Every definition was listed while compiling them, so there is
+    # no need to ask the filesystem again
+    existing = set(manifest['definitions'])
+    missing = {}
+    index.missing.clear()
+    for name in index:
+        if getDefinitionPath(name.link) not in existing:
+            index.missing.add(name.link)
+            missing.setdefault(getOutput(name.link), name)
+
+    return missing, {output: len(referrers.get(output, []))
+                     for output in missing}
+
+
+def reportMissing(missing, counts, top=5):
+    """List the missing targets, the most referred to first."""
+    report = [{'link': missing[output].link, 'output': output,
+               'referrers': counts[output]}
+              for output in sorted(missing,
+                                   key=lambda output: -counts[output])]
+    if report:
+        mostReferred = ", ".join(f"{item['link']} ({item['referrers']})"
+                                 for item in report[:top])
+        LOGGER.info(f"{len(report)} links point at stops without a "
+                    f"definition, most referred to: {mostReferred}")
+    return report
+
+
+def compileMissing(previous, manifest, index, date, templateChanged,
+                   stopOutputs, written, stats):
+    missing, counts = findMissing(manifest, index)
+
+    previousMissing = set(previous['missing'])
+    for output in previousMissing - set(missing):
+        if output in stopOutputs:
+            if output not in written:
+                # A stop page that used to be hidden by a missing page
+                path = stopOutputs[output]
+                compileDefinition(path, date, stats)
+                written.add(output)
+        else:
+            removeOutput(stagingPath(output))
+
+    date = getPageDate(date, os.path.join(TEMPLATES_DIR, "missing.html"))
+    for output, name in missing.items():
+        # Missing pages take precedence over any stop page at the same path,
+        # so they have to be rewritten whenever that stop page was
+        if output not in previousMissing or output in written or \
+                templateChanged or not os.path.exists(stagingPath(output)):
+            start = time.perf_counter()
+            writePage(output, templates["missing.html"].render(
+                name=name, getNameURL=getNameURL, getLetter=getLetter,
+                date=date), stats)
+            stats.recordPage(output, time.perf_counter() - start)
+
+    manifest['missing'] = sorted(missing)
+    return reportMissing(missing, counts)
+
+
+def hashNames(index, names):
+    # Names are shown differently when their stop has no definition
+    return hashBytes(json.dumps([(name.name, name.link,
+                                  name.link in index.missing)
+                                 for name in names]).encode())
+
+
+def getIndexPages(index, mode):
+    """Yield the output, template, digest and render context of each page
+    of the index."""
+    if mode == "single":
+        columns = {letter: index.getColumns(letter, 4) for letter in letters}
+        yield "index.html", "index.html", hashNames(index, index.names), \
+            {'columns': columns}
+        return
+
+    yield "index.html", "landing.html", None, {}
+    for letter in letters:
+        yield f"index-{letter}.html", "letter.html", \
+            hashNames(index, index.getNames(letter)), \
+            {'letter': letter, 'columns': index.getColumns(letter, 4)}
+
+
+def compileIndex(previous, manifest, index, date, changed, mode, stats):
+    # Any definition can change the names on the index
+    date = getPageDate(date, *manifest['definitions'])
+    dateKey = date.isoformat() if sourceDates else None
+    for output, template, digest, context in getIndexPages(index, mode):
+        manifest['index'][output] = [template, digest, dateKey]
+        if previous['index'].get(output) == [template, digest, dateKey] and \
+                not changed[template] and \
+                os.path.exists(stagingPath(output)):
+            LOGGER.debug(f"{output} is unchanged")
+            continue
+
+        start = time.perf_counter()
+        writePage(output, templates[template].render(
+            context, getNameURL=getNameURL, letters=letters,
+            missingLinks=index.missing, date=date),
+            stats)
+        stats.recordPage(output, time.perf_counter() - start)
+
+
+def getModified(path):
+    if path in sourceDates:
+        return sourceDates[path]
+    return datetime.utcfromtimestamp(os.stat(projectPath(path)).st_mtime)
+
+
+def writeSitemap(manifest, siteURL, stats):
+    """List every page but those of missing stops in SITEMAP_FILE, with
+    when the definition behind it last changed."""
+    from xml.sax.saxutils import escape
+
+    modified = {}
+    for path, entry in manifest['definitions'].items():
+        date = getModified(path)
+        for output in entry['outputs']:
+            modified[output] = max(modified.get(output, date), date)
+
+    # Any definition can change the names on the index
+    latest = max(modified.values(), default=None)
+    for output in manifest['index']:
+        modified[output] = latest
+
+    siteURL = siteURL.rstrip("/") + "/"
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for output, date in sorted(modified.items()):
+        url = escape(siteURL + quote(output.replace(os.sep, "/")))
+        if date is None:
+            lines.append(f"  <url><loc>{url}</loc></url>")
+        else:
+            lastModified = date.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+            lines.append(f"  <url><loc>{url}</loc>"
+                         f"<lastmod>{lastModified}</lastmod></url>")
+    lines.append("</urlset>")
+    writePage(SITEMAP_FILE, "\n".join(lines) + "\n", stats)
+    manifest['sitemap'] = True
+
+
+def emptyManifest():
+    return {'version': MANIFEST_VERSION, 'templates': {}, 'assets': {},
+            'definitions': {}, 'missing': [], 'index': {},
+            'compressed': {'formats': [], 'files': {}}, 'derived': [],
+            'fingerprints': {}, 'sitemap': False, 'minified': {}}
+
+
+def main(config, stats=None, missingReport=None, assetReport=None):
+    """Load the templates afresh and build, writing the reports of missing
+    stops and assets to the paths given. Returns the stats of the build."""
+    if stats is None:
+        stats = BuildStats()
+    if stats.traceMemory:
+        tracemalloc.start()
+
+    with stats.phase("build"):
+        with stats.phase("templates"):
+            useProject(config.root)
+            loadTemplates(config.precompile)
+        result = build(config, stats=stats)
+
+    if missingReport:
+        with open(missingReport, "w") as output:
+            json.dump(result.missing, output, indent=2)
+
+    if assetReport:
+        with open(assetReport, "w") as output:
+            json.dump(result.assets, output, indent=2)
+
+    if stats.traceMemory:
+        tracemalloc.stop()
+    return stats
+
+
+def linkOrCopy(source, target):
+    try:
+        os.link(source, target, follow_symlinks=False)
+    except OSError:
+        shutil.copy2(source, target, follow_symlinks=False)
+
+
+def seedStaging():
+    """Start the staging directory off as a copy of the live build.
+
+    Files are hard linked where possible, so outputs that this build
+    does not touch cost nothing to carry over.
+    """
+    live, staging = projectPath(BUILD_DIR), stagingPath()
+    previous = projectPath(PREVIOUS_DIR)
+    if os.path.exists(staging):
+        # Left behind by a build that failed
+        shutil.rmtree(staging)
+    if os.path.exists(previous):
+        # Left behind by a build that failed while publishing, before or
+        # after the staged build took the live one's place
+        if os.path.exists(live):
+            shutil.rmtree(previous)
+        else:
+            os.rename(previous, live)
+
+    if not os.path.exists(live):
+        os.makedirs(staging)
+        return
+
+    shutil.copytree(live, staging, symlinks=True, copy_function=linkOrCopy)
+    removeOutput(stagingPath(MANIFEST_FILE))
+
+
+def getPageOutputs(manifest):
+    outputs = set(manifest['missing'])
+    outputs.update(manifest['index'])
+    for entry in manifest['definitions'].values():
+        outputs.update(entry['outputs'])
+    return outputs
+
+
+def getCommitDates():
+    """Return when the last commit touching each definition and template
+    was made, leaving out files with uncommitted changes."""
+    import subprocess
+
+    command = ["git", "-c", "core.quotePath=false"]
+    sources = ["--", DEFINITIONS_DIR, TEMPLATES_DIR]
+    try:
+        # Run from the project so that the paths are relative to it
+        log = subprocess.run(
+            command + ["log", "--format=@%ct", "--name-only", "--relative"] +
+            sources, capture_output=True, text=True, check=True,
+            cwd=projectDir or None).stdout
+        uncommitted = subprocess.run(
+            command + ["diff", "--name-only", "--relative", "HEAD"] +
+            sources, capture_output=True, text=True, check=True,
+            cwd=projectDir or None).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        LOGGER.warning(f"could not read the git history ({e}), dating "
+                       f"pages by when their files were modified")
+        return {}
+
+    # The log lists the newest commits first
+    dates = {}
+    for line in log.splitlines():
+        if line.startswith("@"):
+            date = datetime.utcfromtimestamp(int(line[1:]))
+        elif line:
+            dates.setdefault(os.path.normpath(line), date)
+    for line in uncommitted.splitlines():
+        dates.pop(os.path.normpath(line), None)
+    return dates
+
+
+def getSourceDates(source):
+    """Return when each definition and template last changed, going by
+    the git history or by their modification times."""
+    paths = listDefinitions() + [os.path.join(TEMPLATES_DIR, template)
+                                 for template in TEMPLATE_NAMES]
+    committed = getCommitDates() if source == "git" else {}
+
+    dates = {}
+    for path in paths:
+        dates[path] = committed.get(path)
+        if dates[path] is None:
+            # Not committed yet
+            dates[path] = datetime.utcfromtimestamp(
+                os.stat(projectPath(path)).st_mtime)
+    return dates
+
+
+def getPageDate(date, *paths):
+    """Return the date to show on a page made from paths: date, the time
+    of the build, unless pages are dated by when their sources changed."""
+    if not sourceDates:
+        return date
+    return max((sourceDates[path] for path in paths), default=date)
+
+
+def listOutputs(root):
+    outputs = set()
+    for subdir, dirs, files in os.walk(root):
+        for file in files:
+            outputs.add(os.path.relpath(os.path.join(subdir, file), root))
+    return outputs.difference(BUILD_RECORDS)
+
+
+def isSameOutput(first, second):
+    import filecmp
+
+    # Outputs this build did not touch are still hard links to the old ones
+    firstStat, secondStat = os.lstat(first), os.lstat(second)
+    if (firstStat.st_dev, firstStat.st_ino) == \
+            (secondStat.st_dev, secondStat.st_ino):
+        return True
+    return filecmp.cmp(first, second, shallow=False)
+
+
+def writeDeployManifest():
+    """Write which outputs the staged build adds, changes and removes
+    compared with the live one to DEPLOY_FILE."""
+    staged = listOutputs(stagingPath())
+    liveDir = projectPath(BUILD_DIR)
+    live = listOutputs(liveDir) if os.path.exists(liveDir) else set()
+    changes = {
+        'added': staged - live,
+        'changed': {output for output in staged & live
+                    if not isSameOutput(stagingPath(output),
+                                        os.path.join(liveDir, output))},
+        'removed': live - staged,
+    }
+    LOGGER.info(", ".join(f"{len(outputs)} outputs {change}"
+                          for change, outputs in changes.items()))
+
+    path = stagingPath(DEPLOY_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({change: sorted(output.replace(os.sep, "/")
+                                  for output in outputs)
+                   for change, outputs in changes.items()}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def minifyOutput(output, previousDigest):
+    """Minify a staged output unless it is the same as when it was last
+    minified.
+
+    Returns the digest of the minified output, and its size before and
+    after if it was minified now.
+    """
+    path = stagingPath(output)
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashBytes(content)
+    if digest == previousDigest:
+        return digest, None
+
+    import minifier
+
+    minified = minifier.minify(content.decode()).encode()
+    # Staged outputs may be hard links into the live build
+    with open(path + ".tmp", 'wb') as f:
+        f.write(minified)
+    os.replace(path + ".tmp", path)
+    return hashBytes(minified), (len(content), len(minified))
+
+
+def minifyOutputs(previous, manifest, jobs):
+    outputs = sorted(getPageOutputs(manifest))
+    results = mapInWorkers(minifyOutput, jobs, outputs,
+                           map(previous['minified'].get, outputs))
+
+    manifest['minified'] = {}
+    original = minified = 0
+    for output, (digest, sizes) in zip(outputs, results):
+        manifest['minified'][output] = digest
+        if sizes is not None:
+            original += sizes[0]
+            minified += sizes[1]
+
+    written = sum(sizes is not None for digest, sizes in results)
+    LOGGER.info(f"minified {written} of {len(outputs)} pages, "
+                f"{original} bytes to {minified} bytes, saving "
+                f"{original - minified} bytes")
+
+
+def getCompressionFormats():
+    formats = ["gzip"]
+    if importlib.util.find_spec("brotli") is not None:
+        formats.append("brotli")
     else:
-        name['exists'] = True
+        LOGGER.info("brotli is not installed, only writing .gz files")
+    return formats
+
+
+def compressOutput(output, formats, previousDigest):
+    """Write compressed siblings of a staged output unless its content
+    is the same as when they were last written.
+
+    Returns the digest of the output, and its size and the size of each
+    sibling if they were written.
+    """
+    path = stagingPath(output)
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashBytes(content)
+    siblings = [path + COMPRESSION_FORMATS[format] for format in formats]
+    if digest == previousDigest and all(map(os.path.exists, siblings)):
+        return digest, None
+
+    sizes = {}
+    for format, sibling in zip(formats, siblings):
+        if format == "brotli":
+            import brotli
+            compressed = brotli.compress(content)
+        else:
+            import gzip
+            # A fixed mtime keeps the file the same for the same page
+            compressed = gzip.compress(content, 9, mtime=0)
+        with open(sibling + ".tmp", 'wb') as f:
+            f.write(compressed)
+        os.replace(sibling + ".tmp", sibling)
+        sizes[format] = len(compressed)
+    return digest, (len(content), sizes)
+
+
+def isCompressed(path):
+    """Tell whether path is the compressed sibling of another file."""
+    return any(path.endswith(extension) and
+               os.path.exists(path[:-len(extension)])
+               for extension in COMPRESSION_FORMATS.values())
+
+
+def getCompressibleOutputs(manifest, extensions):
+    """Return the pages, sitemap and assets whose names end in one of
+    extensions."""
+    outputs = getPageOutputs(manifest)
+    if manifest['sitemap']:
+        outputs.add(SITEMAP_FILE)
+    for assetDir in ASSET_DIRS:
+        outputs.update(getAssetKey(path, stagingPath())
+                       for path in listFiles(stagingPath(assetDir))
+                       if not isCompressed(path))
+    return sorted(output for output in outputs
+                  if output.endswith(tuple(extensions)))
+
+
+def precompressOutputs(previous, manifest, extensions, jobs):
+    formats = getCompressionFormats()
+    previousFiles = previous['compressed']['files'] \
+        if previous['compressed']['formats'] == formats else {}
+    outputs = getCompressibleOutputs(manifest, extensions)
+    results = mapInWorkers(compressOutput, jobs, outputs,
+                           itertools.repeat(formats),
+                           map(previousFiles.get, outputs))
+
+    files = {}
+    original = 0
+    totals = dict.fromkeys(formats, 0)
+    for output, (digest, sizes) in zip(outputs, results):
+        files[output] = digest
+        if sizes is not None:
+            original += sizes[0]
+            for format in formats:
+                totals[format] += sizes[1][format]
+    manifest['compressed'] = {'formats': formats, 'files': files}
+
+    written = sum(sizes is not None for digest, sizes in results)
+    savings = ", ".join(f"{format} {totals[format]} bytes"
+                        for format in formats)
+    LOGGER.info(f"compressed {written} of {len(outputs)} files, "
+                f"{original} bytes to {savings}")
+
+
+def pruneStaging(manifest):
+    """Remove staged pages that this build did not produce."""
+    outputs = getPageOutputs(manifest)
+    outputs.update(BUILD_RECORDS)
+    if manifest['sitemap']:
+        outputs.add(SITEMAP_FILE)
+    outputs.update(manifest['derived'])
+    for format in manifest['compressed']['formats']:
+        outputs.update(output + COMPRESSION_FORMATS[format]
+                       for output in manifest['compressed']['files'])
+
+    staging = stagingPath()
+    for subdir, dirs, files in os.walk(staging, topdown=False):
+        relative = os.path.relpath(subdir, staging)
+        # stageTree keeps the assets in line with their sources, which
+        # leaves only their compressed siblings to this build
+        inAssets = relative.split(os.sep)[0] in ASSET_DIRS
+        for file in files:
+            path = os.path.join(subdir, file)
+            if inAssets and not isCompressed(path):
+                continue
+            output = os.path.normpath(os.path.join(relative, file))
+            if output not in outputs:
+                removeOutput(path)
+        if not inAssets and subdir != staging and not os.listdir(subdir):
+            os.rmdir(subdir)
+
+
+def exchangePaths(first, second):
+    """Swap two paths in one step, returning False where that's unsupported.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                          ctypes.c_char_p, ctypes.c_uint]
+    if renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD,
+                 os.fsencode(second), RENAME_EXCHANGE) != 0:
+        error = ctypes.get_errno()
+        LOGGER.debug(f"could not exchange {first} and {second} "
+                     f"({os.strerror(error)})")
+        return False
+    return True
+
+
+def publishStaging():
+    """Swap the finished staging directory in for the live build."""
+    live, staging = projectPath(BUILD_DIR), stagingPath()
+    if not os.path.exists(live):
+        os.rename(staging, live)
+        return
+
+    if not exchangePaths(staging, live):
+        # Without an exchange there is a moment with no build at all,
+        # but only between two renames
+        previous = projectPath(PREVIOUS_DIR)
+        os.rename(live, previous)
+        os.rename(staging, live)
+        os.rename(previous, staging)
+
+    # The staging directory now holds the previous build
+    shutil.rmtree(staging)
+
+
+def build(config, date=None, stats=None, previous=None):
+    """Build the site into STAGING_DIR and publish it.
+
+    Pages say they were built on date, the current time if not given. An
+    incremental build starts from previous, the manifest of the last build,
+    or reads it from the build if not given. Templates are loaded if they
+    haven't been yet for config.root.
+
+    Returns a BuildResult of the new manifest, the report of missing stops
+    and the audit of the assets.
+    """
+    useProject(config.root)
+    if date is None:
+        date = datetime.utcnow()
+    if stats is None:
+        stats = BuildStats()
+    if not templates:
+        loadTemplates(config.precompile)
+
+    previous = previous if config.incremental else None
+    if previous is None and config.incremental:
+        previous = loadManifest()
+    if previous is None:
+        if config.incremental:
+            LOGGER.info("no usable build manifest, doing a full build")
+        previous = emptyManifest()
+
+    with stats.phase("seed"):
+        seedStaging()
+
+    sourceDates.clear()
+    if config.dateSource:
+        with stats.phase("dates"):
+            sourceDates.update(getSourceDates(config.dateSource))
+
+    manifest = emptyManifest()
+    index = NameIndex()
+
+    # Pages minified by the last build have to be rendered again to stop
+    # minifying them
+    unminify = bool(previous['minified']) and not config.minify
+
+    changed = {}
+    for template in TEMPLATE_NAMES:
+        digest = hashFile(projectPath(TEMPLATES_DIR, template))
+        manifest['templates'][template] = digest
+        changed[template] = previous['templates'].get(template) != digest \
+            or unminify
+
+    with stats.phase("references"):
+        paths, digests, summaries = summarizeDefinitions(previous, stats)
+        assets = listAssets()
+        referenced, missingAssets = resolveReferences(summaries, assets)
+        keep = referenced.keys() if config.onlyReferenced else None
+
+    with stats.phase("assets"):
+        copyAssets(previous, manifest, config.assetMode, keep)
+
+    assetHashes.clear()
+    with stats.phase("images"):
+        derived = loadImageInfo(config.jobs)
+        if keep is not None:
+            for key, info in imageInfo.items():
+                if f"{IMAGES_DIR}/{key}" not in keep:
+                    for variant in info['variants'].values():
+                        del derived[variant['file']]
+        stageDerivatives(manifest, derived)
+
+    with stats.phase("audio"):
+        loadAudioInfo(config.jobs)
+
+    with stats.phase("audit"):
+        audit = auditAssets(assets, referenced, missingAssets)
+
+    assetURLs.clear()
+    if config.fingerprint:
+        with stats.phase("fingerprint"):
+            fingerprintAssets(manifest)
+
+    with stats.phase("definitions"):
+        stopOutputs, written = compileDefinitions(
+            previous, manifest, index, paths, digests, summaries, date,
+            changed["stop.html"], config.jobs, config.precompile, stats)
+        reportClips(manifest)
+
+    with stats.phase("names"):
+        index.sort()
+
+    with stats.phase("missing"):
+        missing = compileMissing(previous, manifest, index, date,
+                                 changed["missing.html"], stopOutputs,
+                                 written, stats)
+
+    with stats.phase("index"):
+        compileIndex(previous, manifest, index, date, changed,
+                     config.indexMode, stats)
+
+    if config.minify:
+        with stats.phase("minify"):
+            minifyOutputs(previous, manifest, config.jobs)
+
+    if config.siteURL:
+        with stats.phase("sitemap"):
+            writeSitemap(manifest, config.siteURL, stats)
+
+    if config.precompress:
+        with stats.phase("compress"):
+            precompressOutputs(previous, manifest, config.precompress,
+                               config.jobs)
+
+    with stats.phase("publish"):
+        pruneStaging(manifest)
+        writeDeployManifest()
+        saveManifest(manifest)
+        publishStaging()
+
+    return BuildResult(manifest, missing, audit)
+
+
+def snapshotSources():
+    """Return the size and modification time of every watched file."""
+    sources = {}
+    for root in WATCHED_DIRS:
+        for subdir, dirs, files in os.walk(projectPath(root)):
+            for file in files:
+                path = os.path.join(subdir, file)
+                try:
+                    fileStat = os.stat(path)
+                except FileNotFoundError:
+                    # Removed while walking, like an editor's swap file
+                    continue
+                sources[path] = (fileStat.st_size, fileStat.st_mtime_ns)
+    return sources
+
+
+def waitForChanges(sources, interval):
+    """Wait until the watched files differ from sources and have stopped
+    changing, and return their new snapshot and the changed paths."""
+    while True:
+        time.sleep(interval)
+        current = snapshotSources()
+        if current != sources:
+            break
+
+    # Editors often save in several steps, such as writing a temporary
+    # file and renaming it, so wait for them to finish
+    while True:
+        time.sleep(interval)
+        settled = snapshotSources()
+        if settled == current:
+            break
+        current = settled
+
+    changed = {path for path in sources.keys() | current.keys()
+               if sources.get(path) != current.get(path)}
+    return current, changed
+
+
+def serveBuild(port, state):
+    """Serve BUILD_DIR on localhost in a background thread.
+
+    HTML pages get RELOAD_SCRIPT added, which reloads them once
+    state['build'] changes. Paths are looked up on every request, so
+    each newly published build is served as soon as it's swapped in.
+    """
+    import http.server
+    import threading
+
+    live = projectPath(BUILD_DIR)
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=live, **kwargs)
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format % args)
+
+        def sendContent(self, content, contentType):
+            self.send_response(200)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == RELOAD_PATH:
+                self.sendContent(str(state['build']).encode(), "text/plain")
+                return
+
+            path = self.translate_path(self.path)
+            if os.path.isdir(path) and self.path.split("?")[0].endswith("/"):
+                path = os.path.join(path, "index.html")
+            if not path.endswith(".html") or not os.path.isfile(path):
+                super().do_GET()
+                return
+
+            with open(path, 'rb') as f:
+                content = f.read()
+            position = content.rfind(b"</body>")
+            if position == -1:
+                position = len(content)
+            content = content[:position] + RELOAD_SCRIPT.encode() + \
+                content[position:]
+            self.sendContent(content, "text/html; charset=utf-8")
+
+    server = http.server.ThreadingHTTPServer(("localhost", port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LOGGER.info(f"serving {live} at http://localhost:{port}/")
+    return server
+
+
+def watch(config, port=None, interval=WATCH_INTERVAL):
+    """Rebuild incrementally whenever a watched file changes, until
+    interrupted.
+
+    The templates, caches and manifest stay in memory between builds, so
+    saving a definition only costs re-rendering its page and the pages
+    that depend on it. If port is given, the build is also served there,
+    and open pages reload after each build.
+    """
+    config = config._replace(incremental=True)
+    state = {'build': 0}
+    useProject(config.root)
+    loadTemplates(config.precompile)
+    sources = snapshotSources()
+    manifest = build(config).manifest
+
+    server = serveBuild(port, state) if port is not None else None
+    LOGGER.info("watching for changes, press Ctrl+C to stop")
+    try:
+        while True:
+            sources, changed = waitForChanges(sources, interval)
+            LOGGER.info(f"{len(changed)} files changed, rebuilding")
+            start = time.perf_counter()
+            try:
+                if any(os.path.dirname(path) == projectPath(TEMPLATES_DIR)
+                       for path in changed):
+                    loadTemplates(config.precompile)
+                manifest = build(config, previous=manifest).manifest
+            except Exception:
+                # Keep watching, the next save may well fix it
+                LOGGER.exception("rebuild failed")
+                continue
+            state['build'] += 1
+            LOGGER.info(f"rebuilt in {time.perf_counter() - start:.3f}s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--incremental", action='store_true',
+                        help="If given, only rebuild pages whose inputs "
+                        "changed since the last build")
+    parser.add_argument("-a", "--asset-mode", choices=STAGING_MODES,
+                        default="copy",
+                        help="How to put images and audio into the build. "
+                        "Unsupported modes fall back to the ones listed "
+                        "after them.")
+    parser.add_argument("-x", "--index-mode", choices=INDEX_MODES,
+                        default="single",
+                        help="Whether to render the index as one page, or as "
+                        "a landing page and a page for each letter")
+    parser.add_argument("-o", "--only-referenced-assets",
+                        action='store_true',
+                        help="If given, only put the images and sound clips "
+                        "that definitions refer to into the build")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes rendering stop pages")
+    parser.add_argument("-c", "--precompile-templates", action='store_true',
+                        help="If given, compile the templates to Python "
+                        "modules and load them from there")
+    parser.add_argument("-n", "--minify", action='store_true',
+                        help="If given, collapse whitespace and strip "
+                        "comments in the pages")
+    parser.add_argument("-z", "--precompress", action='store_true',
+                        help="If given, write .gz (and .br, if brotli is "
+                        "installed) files next to each page")
+    parser.add_argument("--precompress-extensions", nargs="+",
+                        default=PRECOMPRESS_EXTENSIONS,
+                        help="Extensions of the pages, sitemap and assets "
+                        "to precompress")
+    parser.add_argument("-f", "--fingerprint", action='store_true',
+                        help="If given, add a hash of their content to the "
+                        "URLs of images and sound clips, so they can be "
+                        "cached indefinitely")
+    parser.add_argument("-u", "--site-url", type=str,
+                        help="If given, write a sitemap.xml of the pages as "
+                        "published under this URL")
+    parser.add_argument("-d", "--dates", choices=DATE_SOURCES,
+                        help="If given, date each page by when its "
+                        "definition last changed, going by file "
+                        "modification times or the git history, rather than "
+                        "by the build, so that unchanged pages stay the same "
+                        "byte for byte")
+    parser.add_argument("-C", "--directory", type=str,
+                        help="If given, build the site in this directory "
+                        "rather than the current one")
+    parser.add_argument("-r", "--report", type=str,
+                        help="Path to write a JSON report of how long each "
+                        "phase and page took")
+    parser.add_argument("-m", "--trace-memory", action='store_true',
+                        help="If given, also report the peak memory of each "
+                        "phase. This makes the build noticeably slower.")
+    parser.add_argument("-t", "--top", type=int, default=10,
+                        help="Number of slowest pages to list in the report")
+    parser.add_argument("-p", "--profile", type=str,
+                        help="Path to dump cProfile stats of the build to")
+    parser.add_argument("-M", "--missing-report", type=str,
+                        help="Path to write a JSON list of links to stops "
+                        "without a definition, with how many definitions "
+                        "refer to each")
+    parser.add_argument("-A", "--asset-report", type=str,
+                        help="Path to write a JSON report of the assets no "
+                        "definition refers to, those referred to but "
+                        "missing, and those with the same content")
+    parser.add_argument("-w", "--watch", action='store_true',
+                        help="If given, keep rebuilding incrementally "
+                        "whenever definitions, templates, images or audio "
+                        "change")
+    parser.add_argument("-s", "--serve", type=int, nargs="?", const=8000,
+                        metavar="PORT",
+                        help="If given, watch and also serve the build on "
+                        "this port (8000 by default), reloading open pages "
+                        "after each build")
+    parser.add_argument("-l", "--log-level", default="INFO",
+                        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="Least severe messages to log. DEBUG logs a "
+                        "line for every page, which slows the build down.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    config = BuildConfig(
+        args.incremental, args.asset_mode, args.jobs,
+        args.precompile_templates, args.index_mode,
+        tuple(args.precompress_extensions) if args.precompress else (),
+        args.fingerprint, args.site_url, args.dates, args.minify,
+        args.only_referenced_assets, args.directory)
+
+    if args.watch or args.serve is not None:
+        watch(config, args.serve)
+        raise SystemExit
+
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    stats = main(config, BuildStats(args.trace_memory), args.missing_report,
+                 args.asset_report)
+
+    if args.profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+        LOGGER.info(f"wrote profile to {args.profile}, "
+                    f"read it with python3 -m pstats {args.profile}")
 
-f = open(os.path.join("build", "index.html"), "w")
-f.write(indexTemplate.render(getNameURL=getNameURL,
-                             getNames=getNames, letters=letters, date=datetime.utcnow()))
-f.close()
+    if args.report:
+        report = stats.report(args.top)
+        report.update(date=datetime.utcnow().isoformat(),
+                      incremental=args.incremental, jobs=args.jobs)
+        with open(args.report, "w") as output:
+            json.dump(report, output, indent=2)
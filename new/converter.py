@@ -1,14 +1,19 @@
+import hashlib
+import itertools
 import json
 import logging
 import os
 import re
 import string
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import PurePath
 
 from bs4 import BeautifulSoup
 from bs4.element import Comment, NavigableString, Tag
 
+import bundle
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -24,6 +29,10 @@ TONAL_ATTRIBUTES = 'Tonal Attributes'
 UNKNOWN_ORIGIN = 'Unknown'
 VARIANTS = 'Variants'
 
+ConversionResult = namedtuple('ConversionResult',
+                              'stop output error records')
+Document = namedtuple('Document',
+                      'headings name_tables samples_table images examples')
 ExampleData = namedtuple('ExampleData', 'description examples')
 StopName = namedtuple('StopName', 'name origin link primary')
 Summary = namedtuple('Summary', 'description construction usage')
@@ -49,6 +58,23 @@ SKIP = (
 # Characters that start files we shouldn't parse
 HIDDEN_LEADERS = ('_', '.')
 
+# BeautifulSoup tree builders we can parse old pages with.
+# lxml is much faster, but is an optional dependency.
+PARSERS = ('html.parser', 'lxml')
+DEFAULT_PARSER = 'html.parser'
+
+# Bump this whenever a change to the converter changes its output,
+# so that the cache knows every page has to be converted again
+CONVERTER_VERSION = 1
+
+# Records what each converted file came from. It lives with compile.py's
+# caches rather than next to the definitions, which are tracked by git.
+DEFAULT_CACHE_FILE = os.path.join('.cache', 'converter.json')
+
+# How many converted files to record before saving the cache,
+# so an interrupted run can pick up close to where it stopped
+CACHE_SAVE_INTERVAL = 50
+
 
 def get_next_comment(element):
     maybe_comment = element.next_sibling
@@ -86,8 +112,43 @@ def extract_path_from_descendant_link(element, interested_in=1, require=True):
     return path
 
 
-def extract_sound_clips(soup):
-    samples_table = soup.find('table', {'class': 'samples'})
+def index_document(soup):
+    # Walk the tree once and keep everything the extractors look for,
+    # instead of having each of them search the whole document again
+    headings = {}
+    name_tables = []
+    samples_table = None
+    images = []
+    examples = []
+
+    for element in soup.descendants:
+        if not isinstance(element, Tag):
+            continue
+
+        if element.name == 'h2':
+            headings.setdefault(element.text, []).append(element)
+
+        elif element.name == 'table':
+            if samples_table is None and \
+                    'samples' in element.get('class', []):
+                samples_table = element
+
+            if get_previous_comment(element) == NAMES:
+                name_tables.append(element)
+
+        elif element.name == 'img':
+            if SPONSOR_IMG_CLASS not in element.get('class', []):
+                images.append(element)
+
+        elif element.name == 'p':
+            if 'example' in element.get('class', []):
+                examples.append(element)
+
+    return Document(headings, name_tables, samples_table, images, examples)
+
+
+def extract_sound_clips(document):
+    samples_table = document.samples_table
 
     if not samples_table:
         return []
@@ -181,36 +242,34 @@ def extract_sound_clips(soup):
     return clips
 
 
-def extract_example_data(soup):
-    for h2 in soup.find_all('h2'):
-        if h2.text == EXAMPLES:
-            description = get_next_element(h2)
-            if description.name == 'p':
-                description_text = finalize(description.text)
+def extract_example_data(document):
+    # There are some cases without an example block (e.g., Botze)
+    if EXAMPLES not in document.headings:
+        return ExampleData("", [])
 
-            elif isinstance(description, NavigableString):
-                description_text = finalize(description)
+    description = get_next_element(document.headings[EXAMPLES][0])
+    if description.name == 'p':
+        description_text = finalize(description.text)
 
-            else:
-                # TODO: check these cases more carefully
-                return ExampleData("", [])
+    elif isinstance(description, NavigableString):
+        description_text = finalize(description)
 
-            raw_examples = soup.findAll('p', {'class': 'example'})
-            examples = list(map(lambda ex: {
-                'link': '',
-                'name': finalize(ex.text)
-            }, raw_examples))
+    else:
+        # TODO: check these cases more carefully
+        return ExampleData("", [])
 
-            # Sometimes, the last example is missing a closing </p>
-            # If it is, then we discard that example
-            # to avoid returning the entire end of the page as well.
-            if examples and BIBLIOGRAPHY in examples[-1]['name']:
-                examples = examples[:-1]
+    examples = list(map(lambda ex: {
+        'link': '',
+        'name': finalize(ex.text)
+    }, document.examples))
 
-            return ExampleData(description_text, examples)
+    # Sometimes, the last example is missing a closing </p>
+    # If it is, then we discard that example
+    # to avoid returning the entire end of the page as well.
+    if examples and BIBLIOGRAPHY in examples[-1]['name']:
+        examples = examples[:-1]
 
-    # There are some cases without an example block (e.g., Botze)
-    return ExampleData("", [])
+    return ExampleData(description_text, examples)
 
 
 def get_next_element(element):
@@ -221,56 +280,50 @@ def get_next_element(element):
     return current
 
 
-def extract_bibliography(soup):
+def extract_bibliography(document):
     # TODO
     return []
 
 
-def extract_images(soup):
-    images = []
-    for img in soup.find_all("img"):
-        if SPONSOR_IMG_CLASS not in img.get("class", []):
-            images.append({
-                "file": img.get("src"),
-                "subtitle": "",
-            })
-
-    return images
+def extract_images(document):
+    return [{
+        "file": img.get("src"),
+        "subtitle": "",
+    } for img in document.images]
 
 
-def extract_variants(soup):
+def extract_variants(document):
     variants = []
-    for h2 in soup.find_all('h2'):
-        if h2.text == VARIANTS:
-            variants_element = get_next_element(h2)
-            if variants_element.name == 'table':
-                for desc in variants_element.descendants:
-                    if desc.name == 'a':
-                        path = desc['href'].rsplit('/', 1).pop()
-                        variants.append({
-                            "name": finalize(desc.text),
-                            "link": os.path.splitext(path)[0]
-                        })
-            elif variants_element.name == 'a':
-                path = variants_element['href'].rsplit('/', 1).pop()
-                variants.append({
-                    "name": finalize(variants_element.text),
-                    "link": os.path.splitext(path)[0]
-                })
-
-            elif variants_element.name == 'p':
-                # For example, the Celeste page contains a note saying
-                # "All of the celeste stops [...] are listed below"
-                variants_element = get_next_element(variants_element)
+    for h2 in document.headings.get(VARIANTS, []):
+        variants_element = get_next_element(h2)
+        if variants_element.name == 'table':
+            for desc in variants_element.descendants:
+                if desc.name == 'a':
+                    path = desc['href'].rsplit('/', 1).pop()
+                    variants.append({
+                        "name": finalize(desc.text),
+                        "link": os.path.splitext(path)[0]
+                    })
+        elif variants_element.name == 'a':
+            path = variants_element['href'].rsplit('/', 1).pop()
+            variants.append({
+                "name": finalize(variants_element.text),
+                "link": os.path.splitext(path)[0]
+            })
 
-            else:
-                raise RuntimeError(
-                    f'unknown variants element: {variants_element.name}')
+        elif variants_element.name == 'p':
+            # For example, the Celeste page contains a note saying
+            # "All of the celeste stops [...] are listed below"
+            variants_element = get_next_element(variants_element)
+
+        else:
+            raise RuntimeError(
+                f'unknown variants element: {variants_element.name}')
 
     return variants
 
 
-def extract_comparisons(soup):
+def extract_comparisons(document):
     # TODO
     # Make exceptions for "See" in these lines:
     # - The practice is not unknown abroad
@@ -309,8 +362,9 @@ def extract_summary_text(table):
 
         # If there's an img tag here, it will actually be closed,
         # so arbitrarily skip over anything with only a few elements.
-        if 'img' in [desc.name for desc in list(element.descendants)[:5]]:
-            if len(list(element.descendants)) < 10:
+        descendants = list(element.descendants)
+        if 'img' in [desc.name for desc in descendants[:5]]:
+            if len(descendants) < 10:
                 element = element.find_next_sibling('p')
                 continue
 
@@ -325,13 +379,13 @@ def extract_summary_text(table):
         'construction': "",
     }
 
-    text = element.find_all(text=True)
+    text = element.find_all(string=True)
     while get_next_element(element) and \
             get_next_element(element).name in ('p', 'blockquote'):
         element = get_next_element(element)
         if "FOOTER" in element:
             break
-        text += element.find_all(text=True)
+        text += element.find_all(string=True)
 
     current = 'description'
 
@@ -451,45 +505,46 @@ def collect_converted_stops(new_dir):
     return collect_names_with_ext(new_dir, '.json')
 
 
-def parse_old_file(old_path):
+def parse_old_file(old_path, parser=DEFAULT_PARSER):
     LOGGER.debug(f"Will read data from {old_path}")
     with open(old_path, 'r') as data:
-        soup = BeautifulSoup(data.read(), 'html.parser')
+        soup = BeautifulSoup(data.read(), parser)
+
+    document = index_document(soup)
 
     converted = {
         "images": [],
     }
 
     # Find the table with alternate names
-    for table in soup.find_all('table'):
-        if get_previous_comment(table) == NAMES:
-            names = extract_stop_names(table)
-            assert names
-            LOGGER.debug(f"found {len(names)} names")
+    for table in document.name_tables:
+        names = extract_stop_names(table)
+        assert names
+        LOGGER.debug(f"found {len(names)} names")
 
-            converted["names"] = [{
-                "name": name.name,
-                "origin": name.origin,
-                "link": name.link,
-                "primary": name.primary
-            } for name in names]
+        converted["names"] = [{
+            "name": name.name,
+            "origin": name.origin,
+            "link": name.link,
+            "primary": name.primary
+        } for name in names]
 
-            summary = extract_summary_text(table)
+        summary = extract_summary_text(table)
 
-            converted["description"] = summary.description
-            converted["construction"] = summary.construction
-            converted["usage"] = summary.usage
+        converted["description"] = summary.description
+        converted["construction"] = summary.construction
+        converted["usage"] = summary.usage
 
-    converted['images'] = extract_images(soup)
+    converted['images'] = extract_images(document)
 
     LOGGER.debug(f"found {len(converted['images'])} images")
 
-    converted["variants"] = extract_variants(soup)
+    converted["variants"] = extract_variants(document)
     LOGGER.debug(f"found {len(converted['variants'])} variants")
 
-    converted["comparisons"] = extract_comparisons(soup)
+    converted["comparisons"] = extract_comparisons(document)
 
-    example_data = extract_example_data(soup)
+    example_data = extract_example_data(document)
     converted["examplesDescription"] = example_data.description
     if example_data.description:
         LOGGER.debug("found example description text")
@@ -497,7 +552,6 @@ def parse_old_file(old_path):
     else:
         LOGGER.debug("didn't find description text")
 
-    example_data = extract_example_data(soup)
     converted["examples"] = example_data.examples
     if example_data.examples:
         LOGGER.debug(f"found {len(example_data.examples)} examples")
@@ -505,63 +559,237 @@ def parse_old_file(old_path):
     else:
         LOGGER.debug("didn't find examples")
 
-    sound_clips = extract_sound_clips(soup)
+    sound_clips = extract_sound_clips(document)
     converted["soundClips"] = sound_clips
 
     for division in sound_clips:
         LOGGER.debug(f"found {len(division['clips'])} sound clips "
                      f"for division {division['divisionName']}")
 
-    converted["bibliography"] = extract_bibliography(soup)
+    converted["bibliography"] = extract_bibliography(document)
+
+    # The tree is full of parent/child reference cycles, so free it now
+    # rather than whenever the garbage collector gets around to it
+    soup.decompose()
 
     LOGGER.debug(f"Finished reading data from {old_path}")
     return converted
 
 
+def hash_text(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def hash_file(path):
+    with open(path, 'rb') as data:
+        return hashlib.sha256(data.read()).hexdigest()
+
+
 def write_new_file(data, new_file, dry_run):
+    text = json.dumps(data)
     if dry_run:
         LOGGER.debug(f"Would write new file at {new_file}")
 
+    elif os.path.exists(new_file) and hash_file(new_file) == hash_text(text):
+        LOGGER.debug(f"{new_file} is unchanged")
+
     else:
         if not os.path.exists(PurePath(new_file).parent):
             os.mkdir(PurePath(new_file).parent)
 
         with open(new_file, 'w') as output:
-            json.dump(data, output)
+            output.write(text)
 
         LOGGER.debug(f"Wrote new file at {new_file}")
 
+    return hash_text(text)
 
-def convert(stop, old_dir, new_dir, dry_run):
+
+def get_old_path(stop, old_dir):
     old_name = f"{''.join(stop.split('_'))}.html"
 
     if os.path.exists(os.path.join(old_dir, old_name[0].lower(), old_name)):
-        old_path = os.path.join(old_dir, old_name[0].lower(), old_name)
-    else:
-        old_path = os.path.join(old_dir, old_name[0].lower(), f"{stop}.html")
+        return os.path.join(old_dir, old_name[0].lower(), old_name)
+
+    return os.path.join(old_dir, old_name[0].lower(), f"{stop}.html")
+
 
-    new_path = os.path.join(new_dir, old_name[0].lower(), f"{stop}.json")
-    LOGGER.debug(f"will convert {old_name} from {old_path} to {new_path}")
+def get_new_path(stop, new_dir):
+    return os.path.join(new_dir, stop[0].lower(), f"{stop}.json")
 
-    stop_data = parse_old_file(old_path)
-    write_new_file(stop_data, new_path, dry_run)
 
+def convert(stop, old_dir, new_dir, dry_run, parser=DEFAULT_PARSER):
+    old_path = get_old_path(stop, old_dir)
+    new_path = get_new_path(stop, new_dir)
+    LOGGER.debug(f"will convert {os.path.basename(old_path)} "
+                 f"from {old_path} to {new_path}")
 
-def main(old_dir, new_dir, rewrite, dry_run):
+    stop_data = parse_old_file(old_path, parser)
+    return write_new_file(stop_data, new_path, dry_run)
+
+
+def load_cache(path):
+    try:
+        with open(path) as data:
+            return json.load(data)
+    except (OSError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def save_cache(cache, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as output:
+        output.write(json.dumps(cache, indent=1, sort_keys=True))
+    os.replace(path + '.tmp', path)
+
+
+def cache_key(source_hash, parser):
+    return {
+        'source': source_hash,
+        'version': CONVERTER_VERSION,
+        'parser': parser,
+    }
+
+
+def needs_conversion(stop, new_dir, entry, key):
+    new_path = get_new_path(stop, new_dir)
+    if not os.path.exists(new_path):
+        return True
+
+    # Files converted before the cache existed may have been fixed by hand
+    if entry is None:
+        return False
+
+    if all(entry.get(field) == value for field, value in key.items()):
+        return False
+
+    if hash_file(new_path) != entry['output']:
+        LOGGER.warning(f"{new_path} was edited after it was converted, "
+                       "pass --rewrite to convert it again anyway")
+        return False
+
+    return True
+
+
+class RecordCollector(logging.Handler):
+    """Holds on to log records so one file's logs can be emitted together."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Records may cross a process boundary, so flatten anything
+        # that might not pickle
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def convert_isolated(stop, old_dir, new_dir, dry_run, parser):
+    collector = RecordCollector()
+    propagate = LOGGER.propagate
+    LOGGER.addHandler(collector)
+    LOGGER.propagate = False
+    output = error = None
+
+    try:
+        output = convert(stop, old_dir, new_dir, dry_run, parser)
+
+    except Exception as e:
+        LOGGER.exception(f"could not convert {stop}")
+        error = f"{type(e).__name__}: {e}"
+
+    finally:
+        LOGGER.removeHandler(collector)
+        LOGGER.propagate = propagate
+
+    return ConversionResult(stop, output, error, collector.records)
+
+
+def convert_all(stops, old_dir, new_dir, dry_run, parser, jobs):
+    if jobs == 1:
+        for stop in stops:
+            yield convert_isolated(stop, old_dir, new_dir, dry_run, parser)
+        return
+
+    chunksize = max(1, len(stops) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(convert_isolated, stops,
+                                itertools.repeat(old_dir),
+                                itertools.repeat(new_dir),
+                                itertools.repeat(dry_run),
+                                itertools.repeat(parser),
+                                chunksize=chunksize)
+
+
+def list_new_files(new_dir):
+    paths = []
+    for subdir, dirs, files in os.walk(new_dir):
+        dirs.sort()
+        paths.extend(os.path.join(subdir, file) for file in sorted(files)
+                     if file.endswith(".json") and not file.startswith("."))
+    return paths
+
+
+def write_bundle(bundle_path, new_dir):
+    with bundle.Bundle(bundle_path, new_dir) as definitions:
+        definitions.sync(list_new_files(new_dir))
+    LOGGER.info(f"Updated the definitions bundle at {bundle_path}")
+
+
+def main(old_dir, new_dir, rewrite, dry_run, jobs=1, parser=DEFAULT_PARSER,
+         bundle_path=None, cache_path=DEFAULT_CACHE_FILE):
     stops = collect_old_stops(old_dir)
     LOGGER.debug(f"Found {len(stops)} old stops")
 
+    cache = load_cache(cache_path)
+    keys = {stop: cache_key(hash_file(get_old_path(stop, old_dir)), parser)
+            for stop in stops}
+
     if rewrite:
         LOGGER.debug("--rewrite passed, will rewrite all files")
         to_convert = stops
 
     else:
-        converted = collect_converted_stops(new_dir)
-        to_convert = stops - converted
+        to_convert = {stop for stop in stops
+                      if needs_conversion(stop, new_dir, cache.get(stop),
+                                          keys[stop])}
         LOGGER.debug(f"Need to convert {len(to_convert)} stops")
 
-    for stop in sorted(list(to_convert)):
-        convert(stop, old_dir, new_dir, dry_run)
+    failures = {}
+    try:
+        for count, result in enumerate(convert_all(
+                sorted(list(to_convert)), old_dir, new_dir, dry_run, parser,
+                jobs)):
+            for record in result.records:
+                LOGGER.handle(record)
+
+            if result.error:
+                failures[result.stop] = result.error
+
+            elif not dry_run:
+                cache[result.stop] = dict(keys[result.stop],
+                                          output=result.output)
+                if count % CACHE_SAVE_INTERVAL == 0:
+                    save_cache(cache, cache_path)
+
+    finally:
+        if not dry_run:
+            save_cache(cache, cache_path)
+
+    LOGGER.info(f"Converted {len(to_convert) - len(failures)} of "
+                f"{len(to_convert)} stops")
+    for stop, error in sorted(failures.items()):
+        LOGGER.error(f"Failed to convert {stop}: {error}")
+
+    if bundle_path and not dry_run:
+        write_bundle(bundle_path, new_dir)
 
     # These files cover lots of edge cases that came up
     # It's a good idea to uncomment them and check the output manually
@@ -572,6 +800,8 @@ def main(old_dir, new_dir, rewrite, dry_run):
     # convert("Aeoline", old_dir, new_dir)
     # convert("Trumpet", old_dir, new_dir)
 
+    return failures
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -586,6 +816,19 @@ if __name__ == "__main__":
                         help="If given, rewrite existing files")
     parser.add_argument("-d", "--dry-run", action='store_true',
                         help="If given, don't actually write files")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes converting files")
+    parser.add_argument("-p", "--parser", choices=PARSERS,
+                        default=DEFAULT_PARSER,
+                        help="BeautifulSoup tree builder to parse pages with")
+    parser.add_argument("-b", "--bundle", type=str,
+                        help="If given, also update the SQLite bundle of the "
+                        "new definitions at this path, such as "
+                        ".cache/definitions.sqlite for compile.py")
+    parser.add_argument("-c", "--cache", type=str,
+                        default=DEFAULT_CACHE_FILE,
+                        help="Path to the cache of which files were converted "
+                        "from what")
     args = parser.parse_args()
 
     if not os.path.exists(args.old_directory):
@@ -594,4 +837,8 @@ if __name__ == "__main__":
     if not os.path.exists(args.new_directory):
         os.makedirs(args.new_directory)
 
-    main(args.old_directory, args.new_directory, args.rewrite, args.dry_run)
+    failures = main(args.old_directory, args.new_directory, args.rewrite,
+                    args.dry_run, args.jobs, args.parser, args.bundle,
+                    args.cache)
+    if failures:
+        raise SystemExit(1)
@@ -0,0 +1,78 @@
+"""Resizes stop illustrations into the smaller copies that pages show.
+
+Pillow is optional: without it the build uses the images as they are.
+It is only imported once there are images to resize.
+"""
+import importlib.util
+import logging
+import os
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Derivatives by name and maximum width. Images are never scaled up.
+VARIANTS = (("thumbnail", 200), ("web", 800))
+
+JPEG_QUALITY = 85
+
+
+def isAvailable():
+    return importlib.util.find_spec("PIL") is not None
+
+
+def getExtension(image):
+    # The old illustrations are mostly line drawings, which stay sharper
+    # and smaller as PNGs. Only photographs are worth a JPEG.
+    return "jpg" if image.format == "JPEG" else "png"
+
+
+def save(image, path, extension):
+    if extension == "jpg":
+        image.convert("RGB").save(path + ".tmp", "JPEG", quality=JPEG_QUALITY,
+                                  optimize=True, progressive=True)
+    else:
+        image.save(path + ".tmp", "PNG", optimize=True)
+    os.replace(path + ".tmp", path)
+
+
+def resize(image, width, height):
+    from PIL import Image
+
+    if (width, height) == image.size:
+        return image
+
+    # Palette images can't be resampled smoothly. Only the first frame
+    # of an animation is kept.
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info
+                              else "RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGB")
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def makeDerivatives(source, prefix):
+    """Write each variant of source to "<prefix>-<variant>.<extension>".
+
+    Returns the intrinsic size of the source and the extension and size of
+    every variant, or None if Pillow can't read the source.
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(source)
+        image.load()
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f"could not read {source} ({e})")
+        return None
+
+    extension = getExtension(image)
+    info = {'width': image.width, 'height': image.height, 'variants': {}}
+    for name, maxWidth in VARIANTS:
+        width = min(maxWidth, image.width)
+        height = max(1, round(image.height * width / image.width))
+        save(resize(image, width, height), f"{prefix}-{name}.{extension}",
+             extension)
+        info['variants'][name] = {'extension': extension, 'width': width,
+                                  'height': height}
+    return info
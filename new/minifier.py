@@ -0,0 +1,50 @@
+"""Makes rendered pages smaller without changing how they display.
+
+Runs of whitespace are collapsed to a single space, or a single line break
+if they contained one, and comments are removed. The content of <pre>,
+<textarea>, <script> and <style> elements is left exactly as it is, as is
+whitespace inside quoted attribute values.
+"""
+import re
+
+
+TOKENS = re.compile(r"""
+    (?P<comment><!--.*?-->)(?P<trailing>\s*)
+  | (?P<raw><(?P<tag>pre|textarea|script|style)\b.*?</(?P=tag)\s*>)
+  | (?P<element></?[a-zA-Z!](?:"[^"]*"|'[^']*'|[^'">])*>)
+  | (?P<space>\s+)
+""", re.DOTALL | re.IGNORECASE | re.VERBOSE)
+
+ATTRIBUTES = re.compile(r"""("[^"]*"|'[^']*')|\s+""")
+
+# Old Internet Explorer reads these, so they are kept
+CONDITIONAL_COMMENT = re.compile(r"<!--\[if\b|<!\[endif\]", re.IGNORECASE)
+
+
+def collapse(space):
+    if not space:
+        return ""
+    return "\n" if "\n" in space else " "
+
+
+def minifyToken(match):
+    if match.group('comment') is not None:
+        # Along with the whitespace after it, which would otherwise be
+        # left next to the whitespace before it
+        comment = match.group('comment')
+        if CONDITIONAL_COMMENT.match(comment):
+            return comment + collapse(match.group('trailing'))
+        return ""
+
+    if match.group('element') is not None:
+        return ATTRIBUTES.sub(lambda attribute: attribute.group(1) or " ",
+                              match.group('element'))
+
+    if match.group('space') is not None:
+        return collapse(match.group('space'))
+
+    return match.group('raw')
+
+
+def minify(html):
+    return TOKENS.sub(minifyToken, html)
@@ -0,0 +1,123 @@
+"""Immutable records for stop definitions and the names on the index.
+
+Records are namedtuples, so they take little memory, can be hashed and
+can be shared between pages instead of being copied for each one.
+"""
+from collections import namedtuple
+
+
+Name = namedtuple('Name', 'name origin link primary')
+Link = namedtuple('Link', 'name link')
+Image = namedtuple('Image', 'file subtitle')
+ClipFile = namedtuple('ClipFile', 'name file')
+Clip = namedtuple('Clip', 'name organLink organName organBuilderName '
+                  'organBuiltYear files')
+Division = namedtuple('Division', 'divisionName clips')
+Section = namedtuple('Section', 'number name')
+Reference = namedtuple('Reference', 'name number sections')
+Stop = namedtuple('Stop', 'names description construction usage images '
+                  'variants comparisons examplesDescription examples '
+                  'soundClips bibliography')
+
+# A name on the index and the stop it links to
+IndexName = namedtuple('IndexName', 'name link')
+
+REQUIRED = object()
+
+
+class InvalidDefinition(ValueError):
+    pass
+
+
+def getField(item, key, types, where, default=REQUIRED):
+    if not isinstance(item, dict):
+        raise InvalidDefinition(f"{where} should be an object")
+
+    if key not in item:
+        if default is REQUIRED:
+            raise InvalidDefinition(f"{where} has no {key}")
+        return default
+
+    value = item[key]
+    if not isinstance(value, types):
+        raise InvalidDefinition(f"{where}.{key} should be a "
+                                f"{types[0].__name__}, not "
+                                f"{type(value).__name__}")
+    return value
+
+
+def getString(item, key, where, default=REQUIRED):
+    return getField(item, key, (str,), where, default)
+
+
+def getList(item, key, where, load):
+    items = getField(item, key, (list,), where, [])
+    return tuple(load(value, f"{where}.{key}[{position}]")
+                 for position, value in enumerate(items))
+
+
+def loadName(item, where):
+    return Name(getString(item, 'name', where),
+                getString(item, 'origin', where, ""),
+                getString(item, 'link', where, ""),
+                getField(item, 'primary', (bool,), where, False))
+
+
+def loadLink(item, where):
+    return Link(getString(item, 'name', where),
+                getString(item, 'link', where, ""))
+
+
+def loadImage(item, where):
+    return Image(getString(item, 'file', where),
+                 getString(item, 'subtitle', where, ""))
+
+
+def loadClipFile(item, where):
+    return ClipFile(getString(item, 'name', where),
+                    getString(item, 'file', where))
+
+
+def loadClip(item, where):
+    return Clip(getString(item, 'name', where, ""),
+                getString(item, 'organLink', where),
+                getString(item, 'organName', where, ""),
+                getString(item, 'organBuilderName', where, ""),
+                getField(item, 'organBuiltYear', (str, int), where, ""),
+                getList(item, 'files', where, loadClipFile))
+
+
+def loadDivision(item, where):
+    return Division(getString(item, 'divisionName', where, ""),
+                    getList(item, 'clips', where, loadClip))
+
+
+def loadSection(item, where):
+    return Section(getField(item, 'number', (str, int), where, ""),
+                   getString(item, 'name', where, ""))
+
+
+def loadReference(item, where):
+    return Reference(getString(item, 'name', where),
+                     getField(item, 'number', (str, int), where, ""),
+                     getList(item, 'sections', where, loadSection))
+
+
+def loadStop(data):
+    """Check a parsed definition and turn it into a Stop.
+
+    Raises InvalidDefinition, naming the offending field, if the definition
+    does not have the expected shape.
+    """
+    where = "definition"
+    return Stop(getList(data, 'names', where, loadName),
+                getString(data, 'description', where, ""),
+                getString(data, 'construction', where, ""),
+                getString(data, 'usage', where, ""),
+                getList(data, 'images', where, loadImage),
+                getList(data, 'variants', where, loadLink),
+                getList(data, 'comparisons', where, loadLink),
+                getString(data, 'examplesDescription', where, ""),
+                getList(data, 'examples', where, loadLink),
+                getList(data, 'soundClips', where, loadDivision),
+                getList(data, 'bibliography', where, loadReference))
@@ -0,0 +1,163 @@
+"""Reads the length and bitrate of MPEG audio files from their frame headers.
+
+Only the headers are parsed, so this needs nothing beyond the standard
+library, and works on any MPEG-1, MPEG-2 or MPEG-2.5 layer I, II or III file.
+"""
+import logging
+
+
+LOGGER = logging.getLogger(__name__)
+
+VERSION_25, VERSION_2, VERSION_1 = 0, 2, 3
+LAYER_3, LAYER_2, LAYER_1 = 1, 2, 3
+
+# Bitrates in kbit/s by bitrate index, 0 being "free format"
+BITRATES = {
+    (VERSION_1, LAYER_1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320,
+                           352, 384, 416, 448),
+    (VERSION_1, LAYER_2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192,
+                           224, 256, 320, 384),
+    (VERSION_1, LAYER_3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160,
+                           192, 224, 256, 320),
+    (VERSION_2, LAYER_1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160,
+                           176, 192, 224, 256),
+    (VERSION_2, LAYER_2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112,
+                           128, 144, 160),
+}
+BITRATES[VERSION_2, LAYER_3] = BITRATES[VERSION_2, LAYER_2]
+for layer in (LAYER_1, LAYER_2, LAYER_3):
+    BITRATES[VERSION_25, layer] = BITRATES[VERSION_2, layer]
+
+SAMPLE_RATES = {
+    VERSION_1: (44100, 48000, 32000),
+    VERSION_2: (22050, 24000, 16000),
+    VERSION_25: (11025, 12000, 8000),
+}
+
+# Trailing tags that are not audio, but not damage either
+TRAILING_TAGS = (b"TAG", b"APETAGEX", b"LYRICSBEGIN")
+
+
+def parseHeader(data, offset):
+    """Return the length, sample count and sample rate of the frame starting
+    at offset, or None if there is no valid frame header there."""
+    if offset + 4 > len(data):
+        return None
+
+    b1, b2 = data[offset + 1], data[offset + 2]
+    if data[offset] != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrateIndex = b2 >> 4
+    sampleRateIndex = (b2 >> 2) & 3
+    # Free format frames don't say how long they are, so they're skipped too
+    if version == 1 or layer == 0 or bitrateIndex in (0, 15) or \
+            sampleRateIndex == 3:
+        return None
+
+    bitrate = BITRATES[version, layer][bitrateIndex] * 1000
+    sampleRate = SAMPLE_RATES[version][sampleRateIndex]
+    padding = (b2 >> 1) & 1
+
+    if layer == LAYER_1:
+        return (12 * bitrate // sampleRate + padding) * 4, 384, sampleRate
+
+    samples = 576 if layer == LAYER_3 and version != VERSION_1 else 1152
+    return samples // 8 * bitrate // sampleRate + padding, samples, sampleRate
+
+
+def skipID3(data):
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+
+    # The size is "synchsafe": 7 bits per byte
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def findFrame(data, offset):
+    """Find the next frame that is followed by another frame (or the end),
+    so that stray 0xFF bytes are not taken for a frame."""
+    while True:
+        offset = data.find(b"\xff", offset)
+        if offset == -1:
+            return None
+        header = parseHeader(data, offset)
+        if header is not None:
+            following = offset + header[0]
+            if following >= len(data) or \
+                    parseHeader(data, following) is not None:
+                return offset
+        offset += 1
+
+
+def isTrailingTag(data, offset):
+    return any(data.startswith(tag, offset) for tag in TRAILING_TAGS)
+
+
+def parse(data):
+    """Walk every frame of an MPEG audio file's contents.
+
+    Returns its size in bytes, duration in seconds, average bitrate in
+    kbit/s, sample rate, number of frames and how many bytes between the
+    frames were not audio.
+    """
+    info = {'size': len(data), 'duration': 0, 'bitrate': 0, 'sampleRate': 0,
+            'frames': 0, 'damaged': 0}
+
+    offset = findFrame(data, skipID3(data))
+    if offset is None:
+        return info
+
+    samples = 0
+    audioBytes = 0
+    while offset < len(data):
+        header = parseHeader(data, offset)
+        if header is None:
+            if isTrailingTag(data, offset):
+                break
+            resynced = findFrame(data, offset + 1)
+            end = len(data) if resynced is None else resynced
+            info['damaged'] += end - offset
+            offset = end
+            continue
+
+        length, frameSamples, sampleRate = header
+        if offset + length > len(data):
+            # The last frame was cut short
+            info['damaged'] += len(data) - offset
+            break
+
+        info['frames'] += 1
+        info['sampleRate'] = sampleRate
+        samples += frameSamples
+        audioBytes += length
+        offset += length
+
+    if info['frames']:
+        duration = samples / info['sampleRate']
+        info['duration'] = round(duration, 3)
+        info['bitrate'] = round(audioBytes * 8 / duration / 1000)
+    return info
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return parse(f.read())
+
+
+def getProblem(info):
+    """Describe what is wrong with a clip, or return None if it's playable.
+    """
+    if info is None:
+        return "missing"
+    if not info['frames']:
+        return "not MPEG audio"
+    if info['damaged']:
+        return f"damaged ({info['damaged']} bytes are not audio)"
+    return None